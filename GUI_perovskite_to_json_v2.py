@@ -5,14 +5,19 @@ The background is described in the paper ...
 """
 
 import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import customtkinter as ctk
 import numpy as np
-import pandas as pd
 import tkinter as tk
 from tkinter import filedialog
 from tkinter.ttk import Label, Style
 
+from ion_reference import get_ion_table
+from perovskite_batch import convert_file_to_folder
 from perovskite_to_json_v2 import PerovskiteToJson
 
 # Number of possible alternatives for ions
@@ -28,20 +33,25 @@ path_c_ions = os.path.join(path_data_ion_folder, "C-ion_data.xlsx")
 
 def getIonAbbreviationsFromDatabase(file_path):
     """Get the abbreviations for all ions we have data on"""
-    ion_data = pd.read_excel(file_path)
-    ions = ion_data["Abbreviation"].values
-    ions = ions.astype(str)
+    ions = get_ion_table(file_path).abbreviations()
     ions.sort()
-    return list(ions) 
-
-# a_ions_from_database = ["Cs", "MA", "FA"]
-# b_ions_from_database = ["Pb", "Sn"]
-# c_ions_from_database = ["I", "Br", "Cl"]
-a_ions_from_database = ["Cs", "FA", "MA"] + getIonAbbreviationsFromDatabase(path_a_ions)
-b_ions_from_database = ["Pb", "Sn"] + getIonAbbreviationsFromDatabase(path_b_ions)
-c_ions_from_database = ["Br", "I"] + getIonAbbreviationsFromDatabase(path_c_ions)
+    return ions
+
+def loadIonAbbreviationsFromDatabase():
+    """The ions for the A, B and C comboboxes. Slow the first time, as the ion tables are read"""
+    return (["Cs", "FA", "MA"] + getIonAbbreviationsFromDatabase(path_a_ions), 
+            ["Pb", "Sn"] + getIonAbbreviationsFromDatabase(path_b_ions), 
+            ["Br", "I"] + getIonAbbreviationsFromDatabase(path_c_ions))
+
+# Placeholders, used until the ion tables are loaded in the background
+a_ions_from_database = ["Cs", "FA", "MA"]
+b_ions_from_database = ["Pb", "Sn"]
+c_ions_from_database = ["Br", "I"]
 dimensionality_from_database = ["0D", "1D", "2D", "3D", "2D/3D", "Unknown"]
 
+# Output alternatives for batch conversion
+batch_outputs = ["One JSONL file", "One JSON file per composition"]
+
 class Dimensionality(ctk.CTkFrame):
     def __init__(self, master, title, values):
         super().__init__(master) 
@@ -159,6 +169,73 @@ class MyComboboxFrame(ctk.CTkFrame):
         for box in self.boxes:
             box.set("")
 
+    def set_values(self, values):
+        self.values = values
+        for box in self.boxes:
+            box.configure(values=values)
+
+class BatchFrame(ctk.CTkFrame):
+    def __init__(self, master, title, import_command, start_command, cancel_command):
+        super().__init__(master) 
+
+        self.title = ctk.CTkLabel(self, text=title, fg_color="gray30", corner_radius=6, font=new_font)
+        self.title.grid(row=0, column=0, columnspan=4, padx=10, pady=(10, 0), sticky="ew")
+
+        self.import_button = ctk.CTkButton(self, text="Import compositions", command=import_command, font=new_font)
+        self.import_button.grid(row=1, column=0, padx=10, pady=(10, 0), sticky="w")
+
+        self.entrybox = ctk.CTkEntry(self, width=560, placeholder_text="CSV or XLSX file with one composition per row", 
+                                     font=new_font)
+        self.entrybox.grid(row=1, column=1, columnspan=3, padx=10, pady=(10, 0), sticky="w")
+
+        self.output_box = ctk.CTkComboBox(self, width=260, values=batch_outputs, font=new_font)
+        self.output_box.set(batch_outputs[0])
+        self.output_box.grid(row=2, column=0, padx=10, pady=(10, 0), sticky="w")
+
+        self.start_button = ctk.CTkButton(self, text="Convert", command=start_command, font=new_font)
+        self.start_button.grid(row=2, column=1, padx=10, pady=(10, 0), sticky="w")
+
+        self.cancel_button = ctk.CTkButton(self, text="Cancel", command=cancel_command, font=new_font, 
+                                           state="disabled")
+        self.cancel_button.grid(row=2, column=2, padx=10, pady=(10, 0), sticky="w")
+
+        self.progressbar = ctk.CTkProgressBar(self, width=560)
+        self.progressbar.set(0)
+        self.progressbar.grid(row=3, column=0, columnspan=3, padx=10, pady=(10, 0), sticky="w")
+
+        self.progress_label = ctk.CTkLabel(self, text="", font=new_font)
+        self.progress_label.grid(row=3, column=3, padx=10, pady=(10, 10), sticky="w")
+
+    def get(self):
+        return self.entrybox.get().strip()
+
+    def one_file_per_composition(self):
+        return self.output_box.get() == batch_outputs[1]
+
+    def update_textbox(self, text):
+        self.entrybox.delete(0, tk.END)
+        self.entrybox.insert(0, text)
+
+    def set_running(self, running):
+        self.start_button.configure(state="disabled" if running else "normal")
+        self.cancel_button.configure(state="normal" if running else "disabled")
+
+    def show_progress(self, done, total, seconds):
+        self.progressbar.set(done / total if total > 0 else 1)
+        rate = done / seconds if seconds > 0 else 0
+        eta = (total - done) / rate if rate > 0 else float("nan")
+        self.progress_label.configure(text=f"{done}/{total} records, {rate:.0f} records/s, ETA {eta:.0f} s")
+
+class StatusBar(ctk.CTkFrame):
+    def __init__(self, master, text):
+        super().__init__(master) 
+
+        self.label = ctk.CTkLabel(self, width=800, text=text, anchor="w", font=new_font)
+        self.label.grid(row=0, column=0, padx=10, pady=(10, 10), sticky="w")
+
+    def set(self, text):
+        self.label.configure(text=text)
+
 class SaveFolder(ctk.CTkFrame):
         def __init__(self, master, button_text, text, command):
             super().__init__(master) 
@@ -183,7 +260,7 @@ class App(ctk.CTk):
         super().__init__()
 
         self.title("Perovskite description to JSON")
-        self.geometry("1000x950")
+        self.geometry("1000x1150")
         # self.grid_columnconfigure(0, weight=1)
         # self.grid_rowconfigure((0, 1), weight=1)
 
@@ -258,6 +335,100 @@ class App(ctk.CTk):
         self.entrybox_frame_add = EntryboxFrame(self, number_of_boxes=number_of_alternatives, title="Additives. One additive per box")
         self.entrybox_frame_add.grid(row=12, column=0, padx=10, pady=(10, 0), sticky="nsw") 
 
+        # Batch conversion of a whole file of compositions
+        self.batch_frame = BatchFrame(self, title="Batch conversion. Results are saved in the save folder", 
+                                      import_command=self.get_batch_filepath, 
+                                      start_command=self.start_batch, 
+                                      cancel_command=self.cancel_batch)
+        self.batch_frame.grid(row=13, column=0, padx=10, pady=(10, 0), sticky="nsw")
+        self.batch_cancel = threading.Event()
+
+        # Status messages
+        self.status_frame = StatusBar(self, text="")
+        self.status_frame.grid(row=14, column=0, padx=10, pady=(10, 0), sticky="nsw")
+
+        # Slow work runs on a worker thread, and the results are handed back to the main thread 
+        # through a queue that is checked with after(), so the window stays responsive
+        self.worker = ThreadPoolExecutor(max_workers=1)
+        self.finished_tasks = queue.Queue()
+        self.after(100, self.check_finished_tasks)
+
+        # Load the ion tables in the background. The comboboxes show placeholders until then
+        self.status_frame.set("Loading ion tables...")
+        self.run_in_background(loadIonAbbreviationsFromDatabase, callback=self.update_ion_alternatives)
+
+    def get_batch_filepath(self):
+        "Ask user for a file with compositions"
+        file_path = tk.filedialog.askopenfilename(filetypes=[("Compositions", "*.csv *.xlsx"), ("All files", "*")])
+        if file_path:
+            self.batch_frame.update_textbox(text=file_path)
+
+    def start_batch(self):
+        "Convert all compositions in the imported file on a background thread"
+        input_path = self.batch_frame.get()
+        folder_path = self.save_folder_frame.get()
+        one_file_per_composition = self.batch_frame.one_file_per_composition()
+        start_time = time.perf_counter()
+
+        def progress(done, total):
+            # Called on the batch thread, so the progress bar is updated through the queue
+            seconds = time.perf_counter() - start_time
+            self.finished_tasks.put((lambda _: self.batch_frame.show_progress(done, total, seconds), None))
+
+        def run():
+            try:
+                result = convert_file_to_folder(input_path, folder_path, 
+                                                one_file_per_composition=one_file_per_composition, 
+                                                cancel_event=self.batch_cancel, progress=progress)
+            except Exception as error:
+                result = error
+            self.finished_tasks.put((self.batch_finished, result))
+
+        self.batch_cancel.clear()
+        self.batch_frame.set_running(True)
+        self.status_frame.set(f"Converting {input_path}...")
+        threading.Thread(target=run, daemon=True).start()
+
+    def cancel_batch(self):
+        self.batch_cancel.set()
+        self.status_frame.set("Cancelling batch conversion...")
+
+    def batch_finished(self, result):
+        "Report the result of a batch conversion"
+        self.batch_frame.set_running(False)
+        if isinstance(result, Exception):
+            self.status_frame.set(f"Batch conversion failed: {result}")
+        elif self.batch_cancel.is_set():
+            self.status_frame.set(f"Batch conversion cancelled after {result} records")
+        else:
+            self.status_frame.set(f"Batch conversion done, {result} records saved")
+
+    def run_in_background(self, function, *args, callback):
+        "Run function on the worker thread. callback gets the finished future on the main thread"
+        future = self.worker.submit(function, *args)
+        future.add_done_callback(lambda future: self.finished_tasks.put((callback, future)))
+
+    def check_finished_tasks(self):
+        "Call the callbacks of finished background work with their results. Runs on the main thread"
+        while True:
+            try:
+                callback, future = self.finished_tasks.get_nowait()
+            except queue.Empty:
+                break
+            callback(future)
+        self.after(100, self.check_finished_tasks)
+
+    def update_ion_alternatives(self, future):
+        "Put the ions from the ion tables in the comboboxes"
+        if future.exception() is not None:
+            self.status_frame.set(f"Could not load ion tables: {future.exception()}")
+            return
+        a_ions, b_ions, c_ions = future.result()
+        self.combobox_frame_a.set_values(a_ions)
+        self.combobox_frame_b.set_values(b_ions)
+        self.combobox_frame_c.set_values(c_ions)
+        self.status_frame.set("Ready")
+
     def clear_user_input(self):
         "Clear user input"
         self.combobox_frame_a.clear()
@@ -284,7 +455,7 @@ class App(ctk.CTk):
         return ions_formated, coef_formated 
                       
     def generate_json(self):
-        "Put user data together in a json file"
+        "Put user data together in a json file. The conversion and saving run in the background"
         # Clean user input for A-ions
         A_ions, A_coef = self.clean_ion_input(ions=self.combobox_frame_a.get(), 
                                               coef=self.entrybox_frame_a.get())
@@ -299,19 +470,33 @@ class App(ctk.CTk):
         Additives = [x for x in Additives if x !=""]
         Additives.sort()
         
-        # Generate a perovskite Json object
-        perovskite = PerovskiteToJson(A_ions=A_ions, 
-                                A_coef=A_coef, 
-                                B_ions=B_ions, 
-                                B_coef=B_coef, 
-                                C_ions=C_ions, 
-                                C_coef=C_coef, 
-                                Eg=self.entrybox_frame_Eg.get(), 
-                                Dimensionality=self.combobox_frame_dim.get(), 
-                                Additives=Additives)
-
-        # Save the generated JSON object
-        self.save_json(perovskite)
+        # All user input is read here, on the main thread
+        user_input = dict(A_ions=A_ions, 
+                          A_coef=A_coef, 
+                          B_ions=B_ions, 
+                          B_coef=B_coef, 
+                          C_ions=C_ions, 
+                          C_coef=C_coef, 
+                          Eg=self.entrybox_frame_Eg.get(), 
+                          Dimensionality=self.combobox_frame_dim.get(), 
+                          Additives=Additives)
+        file_path = self.get_save_path()
+
+        self.status_frame.set("Generating JSON file...")
+        self.run_in_background(self.convert_and_save, user_input, file_path, callback=self.json_generated)
+
+    def convert_and_save(self, user_input, file_path):
+        "Generate a perovskite Json object and save it. Runs on the worker thread"
+        perovskite = PerovskiteToJson(**user_input, lazy=True)
+        perovskite.save_data(file_path)
+        return file_path
+
+    def json_generated(self, future):
+        "Report the result of generate_json"
+        if future.exception() is not None:
+            self.status_frame.set(f"Could not generate JSON file: {future.exception()}")
+        else:
+            self.status_frame.set(f"Saved {future.result()}")
         
     def get_filepath(self):
         "Ask user for a path to the catalog to store the files"
@@ -320,6 +505,10 @@ class App(ctk.CTk):
 
     def save_json(self, perovskite):
         """Save the generated Json file"""
+        perovskite.save_data(self.get_save_path())
+
+    def get_save_path(self):
+        """The file path given by the save folder and the file name"""
         folder_path = self.save_folder_frame.get()
         file_name = self.file_name_frame.get()
         
@@ -329,9 +518,7 @@ class App(ctk.CTk):
         if file_name[-5:] != ".json":
             file_name = file_name + ".json"
             
-        file_path = os.path.join(folder_path, file_name)
-        # Save data  
-        perovskite.save_data(file_path)
+        return os.path.join(folder_path, file_name)
 
 app = App()
 app.mainloop()
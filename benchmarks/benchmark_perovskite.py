@@ -0,0 +1,195 @@
+"""
+Benchmarks for the conversion of perovskite compositions to Json
+
+Every stage of PerovskiteToJson is timed separately on synthetic compositions
+made from the abbreviations in Data_ions. The composition cache is cleared
+before every run, so the times are for compositions not converted before.
+The results are saved as Json, and can be compared with the results from an
+earlier run.
+
+Run from the root of the repository:
+    python benchmarks/benchmark_perovskite.py --sizes 1 1000 100000 --output bench.json
+    python benchmarks/benchmark_perovskite.py --compare bench.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ion_reference import get_ion_table
+from perovskite_batch import convert_many
+from perovskite_to_json_v2 import PerovskiteToJson, composition_cache, path_a_ions, path_b_ions, path_c_ions
+
+stages = ("construction", "sort_ions", "get_short_formula", "get_long_formula", 
+          "get_ion_complementary_data", "convert_to_json", "save_data", "convert_many")
+
+
+def synthetic_compositions(n, seed=0):
+    "n random compositions made from the ions in the ion tables"
+    rng = random.Random(seed)
+    abbreviations = [get_ion_table(file_path).abbreviations() 
+                     for file_path in (path_a_ions, path_b_ions, path_c_ions)]
+    compositions = []
+    for _ in range(n):
+        composition = {}
+        for site, ions, max_ions in zip("ABC", abbreviations, (3, 2, 2)):
+            chosen = rng.sample(ions, rng.randint(1, max_ions))
+            composition[site + "_ions"] = chosen
+            composition[site + "_coef"] = [round(rng.random(), 2) for _ in chosen]
+        composition["Eg"] = round(rng.uniform(1.2, 3.0), 2)
+        composition["Dimensionality"] = rng.choice(["2D", "3D"])
+        composition["Additives"] = []
+        compositions.append(composition)
+    return compositions
+
+
+def copy_composition(composition):
+    return {key: list(value) if isinstance(value, list) else value for key, value in composition.items()}
+
+
+def time_stage(stage, compositions, folder):
+    "Seconds to run one stage for all compositions, starting with an empty composition cache"
+    # Otherwise every run after the first, and every stage after construction, finds all
+    # compositions in the cache
+    composition_cache.clear()
+    if stage == "construction":
+        inputs = [copy_composition(c) for c in compositions]
+        start = time.perf_counter()
+        for c in inputs:
+            PerovskiteToJson(**c, lazy=True).to_dict()
+        return time.perf_counter() - start
+
+    if stage == "convert_many":
+        frame = pd.DataFrame(compositions)
+        start = time.perf_counter()
+        convert_many(frame)
+        return time.perf_counter() - start
+
+    objects = [PerovskiteToJson(**copy_composition(c), lazy=True) for c in compositions]
+
+    if stage == "sort_ions":
+        inputs = [copy_composition(c) for c in compositions]
+        start = time.perf_counter()
+        for p, c in zip(objects, inputs):
+            p.sort_ions(c["A_ions"], c["A_coef"])
+            p.sort_ions(c["B_ions"], c["B_coef"])
+            p.sort_ions(c["C_ions"], c["C_coef"])
+        return time.perf_counter() - start
+
+    if stage == "get_short_formula":
+        start = time.perf_counter()
+        for p in objects:
+            p.get_short_formula()
+        return time.perf_counter() - start
+
+    if stage == "get_long_formula":
+        start = time.perf_counter()
+        for p in objects:
+            p.get_long_formula()
+        return time.perf_counter() - start
+
+    if stage == "get_ion_complementary_data":
+        start = time.perf_counter()
+        for p in objects:
+            p.get_ion_complementary_data(p.A_ions, path_a_ions)
+            p.get_ion_complementary_data(p.B_ions, path_b_ions)
+            p.get_ion_complementary_data(p.C_ions, path_c_ions)
+        return time.perf_counter() - start
+
+    # Enrich first, so only the serialization is timed
+    for p in objects:
+        p.enrich_ions()
+
+    if stage == "convert_to_json":
+        start = time.perf_counter()
+        for p in objects:
+            p.convert_to_json()
+        return time.perf_counter() - start
+
+    if stage == "save_data":
+        for p in objects:
+            p.json = p.convert_to_json()
+        paths = [os.path.join(folder, f"{i}.json") for i in range(len(objects))]
+        start = time.perf_counter()
+        for p, path in zip(objects, paths):
+            p.save_data(path)
+        return time.perf_counter() - start
+
+    raise ValueError(f"Unknown stage: {stage}")
+
+
+def run_benchmarks(sizes, stage_names=stages, repeat=3, seed=0):
+    "Best time of repeat runs for every stage and size"
+    results = []
+    for n in sizes:
+        compositions = synthetic_compositions(n, seed=seed)
+        for stage in stage_names:
+            times = []
+            for _ in range(repeat):
+                folder = tempfile.mkdtemp(prefix="perovskite_benchmark_")
+                try:
+                    times.append(time_stage(stage, compositions, folder))
+                finally:
+                    shutil.rmtree(folder, ignore_errors=True)
+            best = min(times)
+            results.append({
+                "stage": stage,
+                "n": n,
+                "seconds": best,
+                "us_per_composition": best / n * 1e6,
+                "compositions_per_second": n / best if best > 0 else float("inf"),
+            })
+            print(f"{stage:<28} n={n:<8} {best:10.4f} s {best / n * 1e6:10.2f} us/composition", 
+                  file=sys.stderr)
+    return {
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": sys.version.split()[0],
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "seed": seed,
+        "results": results,
+    }
+
+
+def compare(current, previous):
+    "Print the time ratio, current / previous, for every stage and size in both runs"
+    old = {(r["stage"], r["n"]): r["seconds"] for r in previous["results"]}
+    print(f"{'stage':<28} {'n':>8} {'previous':>10} {'current':>10} {'ratio':>7}")
+    for r in current["results"]:
+        key = (r["stage"], r["n"])
+        if key in old:
+            ratio = r["seconds"] / old[key] if old[key] > 0 else float("nan")
+            print(f"{r['stage']:<28} {r['n']:>8} {old[key]:10.4f} {r['seconds']:10.4f} {ratio:7.2f}")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the perovskite to Json conversion")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1, 1000, 100000])
+    parser.add_argument("--stages", nargs="+", default=list(stages), choices=stages)
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="benchmark_results.json", help="Json file for the results")
+    parser.add_argument("--compare", help="Results from an earlier run to compare with")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes, stage_names=args.stages, repeat=args.repeat, seed=args.seed)
+    with open(args.output, "w") as outfile:
+        json.dump(results, outfile, indent=4)
+    if args.compare:
+        with open(args.compare) as infile:
+            compare(results, json.load(infile))
+
+
+if __name__ == "__main__":
+    main()
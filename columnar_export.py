@@ -0,0 +1,231 @@
+"""
+Functionality for exporting perovskite records to columnar files for analysis
+
+Records in the convert_to_json format are written to Parquet or Arrow IPC
+(feather) files, in row groups of row_group_size records, so a corpus can be
+streamed to disk and loaded into pandas without parsing Json. Two layouts:
+
+    "list"      One row per record. The per-ion fields (A_ions, A_coef,
+                A_SMILES, ...) are list columns with the same names as in
+                the Json records.
+    "exploded"  One row per ion, with the record_id, the site (A, B or C),
+                the position of the ion on the site, the ion, its
+                coefficient and data, and the composition fields repeated.
+                A record without ions gets one row with null site,
+                position and ion fields, so every record_id is kept.
+
+Requires pyarrow, which is an optional dependency (pip install pyarrow).
+"""
+
+import math
+
+sites = ("A", "B", "C")
+
+# The per-ion fields of a record, without the site prefix
+ion_fields = ("ions", "coef", "SMILES", "molecular_formula", "IUPAC_names", "common_names",
+              "cas_numbers", "parent_SMILES", "parent_IUPAC_names", "parent_cas_numbers")
+
+# Column names for the per-ion fields in the exploded layout
+exploded_names = ("ion", "coef", "SMILES", "molecular_formula", "IUPAC_name", "common_name",
+                  "cas_number", "parent_SMILES", "parent_IUPAC_name", "parent_cas_number")
+
+composition_fields = ("Perovskite family", "Perovskite composition", "Band gap", "Dimensionality")
+
+
+def import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.ipc
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError("Columnar export needs pyarrow. Install it with: pip install pyarrow") from error
+    return pyarrow
+
+
+def as_float(value):
+    "Coefficients and band gaps as floats, NaN if missing or not a number"
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def as_string(value):
+    return "" if value is None else str(value)
+
+
+def list_schema(pa):
+    fields = [
+        pa.field("Perovskite family", pa.string()),
+        pa.field("Perovskite composition", pa.string()),
+        pa.field("Band gap", pa.float64()),
+        pa.field("Dimensionality", pa.string()),
+    ]
+    for site in sites:
+        for name in ion_fields:
+            value_type = pa.float64() if name == "coef" else pa.string()
+            fields.append(pa.field(f"{site}_{name}", pa.list_(value_type)))
+    fields.append(pa.field("Additives", pa.list_(pa.string())))
+    return pa.schema(fields)
+
+
+def exploded_schema(pa):
+    fields = [
+        pa.field("record_id", pa.int64()),
+        pa.field("Perovskite family", pa.string()),
+        pa.field("Perovskite composition", pa.string()),
+        pa.field("Band gap", pa.float64()),
+        pa.field("Dimensionality", pa.string()),
+        pa.field("Additives", pa.list_(pa.string())),
+        pa.field("site", pa.string()),
+        pa.field("position", pa.int32()),
+    ]
+    for name in exploded_names:
+        fields.append(pa.field(name, pa.float64() if name == "coef" else pa.string()))
+    return pa.schema(fields)
+
+
+class ColumnarWriter:
+    "Stream perovskite records to a Parquet or Arrow IPC file, one row group at a time"
+    def __init__(self, file_path, file_format=None, layout="list", row_group_size=10000, compression="zstd"):
+        self.pa = import_pyarrow()
+        if file_format is None:
+            file_format = "parquet" if str(file_path).endswith(".parquet") else "arrow"
+        if file_format not in ("parquet", "arrow"):
+            raise ValueError(f"Unknown columnar format: {file_format}. Use parquet or arrow")
+        if layout not in ("list", "exploded"):
+            raise ValueError(f"Unknown layout: {layout}. Use list or exploded")
+        self.file_path = file_path
+        self.file_format = file_format
+        self.layout = layout
+        self.row_group_size = row_group_size
+        self.schema = list_schema(self.pa) if layout == "list" else exploded_schema(self.pa)
+        self.count = 0
+        self._buffered = 0
+        self._reset_columns()
+
+        if file_format == "parquet":
+            self._writer = self.pa.parquet.ParquetWriter(file_path, self.schema, compression=compression)
+        else:
+            self._writer = self.pa.ipc.new_file(file_path, self.schema)
+
+    def write(self, record):
+        "Add one record (a dictionary or a PerovskiteToJson object)"
+        if hasattr(record, "to_dict"):
+            record = record.to_dict()
+        if self.layout == "list":
+            self._add_list_row(record)
+        else:
+            self._add_exploded_rows(record)
+        self.count += 1
+        self._buffered += 1
+        if self._buffered >= self.row_group_size:
+            self.flush()
+
+    def write_many(self, records):
+        for record in records:
+            self.write(record)
+
+    def _reset_columns(self):
+        # List columns are kept as flat values plus offsets, which is much faster to convert
+        self._columns = {name: [] for name in self.schema.names}
+        self._offsets = {field.name: [0] for field in self.schema if self.pa.types.is_list(field.type)}
+
+    def _add_list_row(self, record):
+        columns = self._columns
+        offsets = self._offsets
+        columns["Perovskite family"].append(as_string(record["Perovskite family"]))
+        columns["Perovskite composition"].append(as_string(record["Perovskite composition"]))
+        columns["Band gap"].append(as_float(record["Band gap"]))
+        columns["Dimensionality"].append(as_string(record["Dimensionality"]))
+        for site in sites:
+            for name in ion_fields:
+                column = f"{site}_{name}"
+                convert = as_float if name == "coef" else as_string
+                columns[column].extend([convert(x) for x in record[column]])
+                offsets[column].append(len(columns[column]))
+        columns["Additives"].extend([as_string(x) for x in record["Additives"]])
+        offsets["Additives"].append(len(columns["Additives"]))
+
+    def _add_exploded_rows(self, record):
+        columns = self._columns
+        composition = (as_string(record["Perovskite family"]), as_string(record["Perovskite composition"]),
+                       as_float(record["Band gap"]), as_string(record["Dimensionality"]))
+        additives = [as_string(x) for x in record["Additives"]]
+        offsets = self._offsets["Additives"]
+
+        def add_row(site, position):
+            columns["record_id"].append(self.count)
+            for field, value in zip(composition_fields, composition):
+                columns[field].append(value)
+            columns["Additives"].extend(additives)
+            offsets.append(len(columns["Additives"]))
+            columns["site"].append(site)
+            columns["position"].append(position)
+
+        rows = 0
+        for site in sites:
+            values = [record[f"{site}_{name}"] for name in ion_fields]
+            for position, ion in enumerate(values[0]):
+                add_row(site, position)
+                for name, column_values in zip(exploded_names, values):
+                    value = column_values[position] if position < len(column_values) else None
+                    columns[name].append(as_float(value) if name == "coef" else as_string(value))
+                rows += 1
+        if rows == 0:
+            add_row(None, None)
+            for name in exploded_names:
+                columns[name].append(None)
+
+    def flush(self):
+        "Write the buffered records as one row group"
+        if self._buffered == 0:
+            return
+        pa = self.pa
+        arrays = []
+        for field in self.schema:
+            values = self._columns[field.name]
+            if pa.types.is_list(field.type):
+                arrays.append(pa.ListArray.from_arrays(pa.array(self._offsets[field.name], pa.int32()), 
+                                                       pa.array(values, field.type.value_type)))
+            else:
+                arrays.append(pa.array(values, field.type))
+        self._writer.write_table(pa.Table.from_arrays(arrays, schema=self.schema))
+        self._reset_columns()
+        self._buffered = 0
+
+    def close(self):
+        if self._writer is None:
+            return
+        self.flush()
+        self._writer.close()
+        self._writer = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def write_columnar(records, file_path, file_format=None, layout="list", row_group_size=10000):
+    "Write records from any iterable to a Parquet or Arrow file. Returns the number of records"
+    with ColumnarWriter(file_path, file_format=file_format, layout=layout, row_group_size=row_group_size) as writer:
+        writer.write_many(records)
+    return writer.count
+
+
+def read_columnar(file_path, file_format=None, as_pandas=True, columns=None):
+    """Read a file written by ColumnarWriter. The file is memory mapped, and Arrow IPC files
+    are read without copying. Returns a pandas DataFrame, or a pyarrow Table if as_pandas is False"""
+    pa = import_pyarrow()
+    if file_format is None:
+        file_format = "parquet" if str(file_path).endswith(".parquet") else "arrow"
+    if file_format == "parquet":
+        table = pa.parquet.read_table(file_path, columns=columns, memory_map=True)
+    else:
+        with pa.memory_map(str(file_path), "r") as source:
+            table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            table = table.select(columns)
+    return table.to_pandas() if as_pandas else table
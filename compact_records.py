@@ -0,0 +1,173 @@
+"""
+Functionality for keeping many perovskite records in memory
+
+A record in the convert_to_json format is a dictionary with about 35 lists of
+mostly repeated strings. CompactCorpus stores every record as a CompactRecord
+with __slots__, where the ions, together with their data from the ion tables,
+and the dimensionality and additives are integer indices into interned tables
+shared by the whole corpus, and the coefficients are a float array. Coefficients
+that are not numbers, e.g. strings typed in the GUI, are interned and kept as
+they are. The full record, with the formulas, is only put together when a record
+is read.
+"""
+
+import json
+from array import array
+
+import numpy as np
+
+from perovskite_to_json_v2 import coefficient_string, enclose_ion
+
+sites = ("A", "B", "C")
+
+# The fields stored for every ion, in the order they are interned
+ion_fields = ("ions", "SMILES", "molecular_formula", "IUPAC_names", "common_names",
+              "cas_numbers", "parent_SMILES", "parent_IUPAC_names", "parent_cas_numbers")
+
+
+class StringPool:
+    "Interned values. Each distinct value is stored once and referred to by its index"
+    def __init__(self):
+        self.values = []
+        self._index = {}
+
+    def add(self, value):
+        "The index of a value, adding it if it is new"
+        index = self._index.get(value)
+        if index is None:
+            index = self._index[value] = len(self.values)
+            self.values.append(value)
+        return index
+
+    def __getitem__(self, index):
+        return self.values[index]
+
+    def __len__(self):
+        return len(self.values)
+
+
+class CompactRecord:
+    "One perovskite composition, with indices into the pools of a CompactCorpus"
+    __slots__ = ("ions", "coef", "site_counts", "int_coef", "other_coef", "band_gap", "dimensionality", 
+                 "additives")
+
+    def __init__(self, ions, coef, site_counts, int_coef, other_coef, band_gap, dimensionality, additives):
+        self.ions = ions
+        self.coef = coef
+        self.site_counts = site_counts
+        self.int_coef = int_coef
+        self.other_coef = other_coef
+        self.band_gap = band_gap
+        self.dimensionality = dimensionality
+        self.additives = additives
+
+
+class CompactCorpus:
+    "A compact in-memory collection of perovskite records"
+    def __init__(self):
+        # One pool per site of the ions and their data, and pools for the other strings
+        self.ion_pools = [StringPool() for _ in sites]
+        self.dimensionality_pool = StringPool()
+        # Coefficients that are not int or float, stored with their type so "1" and 1 are kept apart
+        self.coefficient_pool = StringPool()
+        self.additive_pool = StringPool()
+        self.records = []
+
+    def add(self, record):
+        "Add a record (a dictionary in the convert_to_json format or a PerovskiteToJson object)"
+        if hasattr(record, "to_dict"):
+            record = record.to_dict()
+
+        ions = array("i")
+        coef = array("d")
+        site_counts = []
+        int_coef = 0
+        other_coef = 0
+        for site, pool in zip(sites, self.ion_pools):
+            entries = zip(*[record[site + "_" + field] for field in ion_fields])
+            n = 0
+            for entry in entries:
+                ions.append(pool.add(entry))
+                n += 1
+            site_counts.append(n)
+
+            # Coefficients given as integers or as other values, e.g. strings, are flagged 
+            # so they are written back the same way
+            for x in record[site + "_coef"][:n]:
+                if isinstance(x, (int, np.integer)) and not isinstance(x, bool):
+                    int_coef |= 1 << len(coef)
+                    coef.append(float(x))
+                elif isinstance(x, (float, np.floating)):
+                    coef.append(float(x))
+                else:
+                    other_coef |= 1 << len(coef)
+                    coef.append(self.coefficient_pool.add((type(x), x)))
+
+        self.records.append(CompactRecord(
+            ions=ions,
+            coef=coef,
+            site_counts=bytes(site_counts),
+            int_coef=int_coef,
+            other_coef=other_coef,
+            band_gap=record["Band gap"],
+            dimensionality=self.dimensionality_pool.add(record["Dimensionality"]),
+            additives=array("i", [self.additive_pool.add(x) for x in record["Additives"]]),
+        ))
+
+    def extend(self, records):
+        for record in records:
+            self.add(record)
+
+    def __len__(self):
+        return len(self.records)
+
+    def __getitem__(self, index):
+        "The full record as a dictionary in the convert_to_json format"
+        return self.to_dict(self.records[index])
+
+    def __iter__(self):
+        for record in self.records:
+            yield self.to_dict(record)
+
+    def to_dict(self, record):
+        "Put together the full record for a CompactRecord"
+        site_data = []
+        start = 0
+        for pool, n in zip(self.ion_pools, record.site_counts):
+            entries = [pool[i] for i in record.ions[start:start+n]]
+            coef = [self.coefficient(record, i) for i in range(start, start+n)]
+            site_data.append((entries, coef))
+            start += n
+
+        short_formula = ""
+        long_formula = ""
+        for entries, coef in site_data:
+            for entry, x in zip(entries, coef):
+                short_formula += enclose_ion(entry[0])
+                long_formula += enclose_ion(entry[0]) + coefficient_string(x)
+
+        data = {
+            "Perovskite family": short_formula,
+            "Perovskite composition": long_formula,
+            "Band gap": record.band_gap,
+            "Dimensionality": self.dimensionality_pool[record.dimensionality],
+        }
+        for site, (entries, coef) in zip(sites, site_data):
+            data[site + "_ions"] = [entry[0] for entry in entries]
+            data[site + "_coef"] = coef
+            for i, field in enumerate(ion_fields[1:], start=1):
+                data[site + "_" + field] = [entry[i] for entry in entries]
+        data["Additives"] = [self.additive_pool[i] for i in record.additives]
+        return data
+
+    def coefficient(self, record, i):
+        "Coefficient number i of a record, as it was added"
+        if record.int_coef >> i & 1:
+            return int(record.coef[i])
+        if record.other_coef >> i & 1:
+            return self.coefficient_pool[int(record.coef[i])][1]
+        return record.coef[i]
+
+    def to_json(self, index, indent=4):
+        "One record as a Json string, by default formatted like PerovskiteToJson.convert_to_json"
+        return json.dumps(self[index], indent=indent)
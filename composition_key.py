@@ -0,0 +1,170 @@
+"""
+Functionality for identifying and removing duplicate perovskite compositions
+
+The canonical key of a composition has the ions of every site in sorted
+order, cleaned like in PerovskiteToJson, with the coefficients rounded to a
+number of decimals (precision). Compositions that only differ in the order
+of the ions, in parentheses around the ions or in rounding errors of the
+coefficients, e.g. 0.1 and 0.10000000001, get the same key:
+
+    A:Cs=0.05,FA=0.95|B:Pb=1|C:Br=0.5,I=2.5
+
+The composition hash is a stable hash of the key, which is the same in
+every process and Python version, unlike hash().
+
+deduplicate streams records of any number into hash partitioned temporary
+files, and merges the records with the same key one partition at a time, so
+only one partition is in memory at a time. The band gaps of the duplicates
+are averaged and their additives combined.
+
+Example:
+    report = deduplicate_json_lines("Data/all.jsonl", "Data/unique.jsonl")
+"""
+
+import argparse
+import hashlib
+import math
+import os
+import tempfile
+
+from perovskite_batch import sites
+from perovskite_to_json_v2 import clean_ion
+from record_writers import JsonLinesWriter, read_json_lines
+
+
+def quantize(coef, precision=6):
+    "A coefficient as a string, rounded to precision decimals and without trailing zeros"
+    try:
+        value = float(coef)
+    except (TypeError, ValueError):
+        return str(coef).strip()
+    if math.isnan(value) or math.isinf(value):
+        return str(value)
+    text = f"{round(value, precision):.{precision}f}".rstrip("0").rstrip(".")
+    return "0" if text in ("-0", "") else text
+
+
+def site_key(ions, coef, precision=6):
+    "The sorted ion=coefficient pairs of one site. Missing coefficients are nan"
+    pairs = []
+    for i, ion in enumerate(ions):
+        pairs.append((clean_ion(str(ion)), quantize(coef[i] if i < len(coef) else math.nan, precision)))
+    return ",".join([f"{ion}={x}" for ion, x in sorted(pairs)])
+
+
+def canonical_key(A_ions, A_coef, B_ions, B_coef, C_ions, C_coef, precision=6):
+    "The canonical key of a composition"
+    return "|".join([f"{site}:{site_key(ions, coef, precision)}" for site, ions, coef in
+                     zip(sites, (A_ions, B_ions, C_ions), (A_coef, B_coef, C_coef))])
+
+
+def record_key(record, precision=6):
+    "The canonical key of a perovskite record (a dictionary or a PerovskiteToJson object)"
+    if hasattr(record, "to_dict"):
+        record = record.to_dict()
+    return canonical_key(*[record.get(f"{site}_{field}", []) for site in sites for field in ("ions", "coef")],
+                         precision=precision)
+
+
+def composition_hash(key):
+    "A stable 128 bit hash of a canonical key, as 32 hexadecimal characters"
+    return hashlib.blake2b(key.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def band_gap_values(record):
+    "The band gaps of a record as floats, without missing values"
+    values = record.get("Band gap")
+    if not isinstance(values, list):
+        values = [values]
+    gaps = []
+    for value in values:
+        try:
+            value = float(value)
+        except (TypeError, ValueError):
+            continue
+        if not math.isnan(value):
+            gaps.append(value)
+    return gaps
+
+
+class MergedRecord:
+    "The first of a group of duplicate records, with the band gaps and additives of all of them"
+    def __init__(self, record, order):
+        self.record = record
+        self.order = order
+        self.count = 1
+        self.band_gaps = band_gap_values(record)
+        self.additives = list(record.get("Additives", []))
+
+    def add(self, record):
+        self.count += 1
+        self.band_gaps.extend(band_gap_values(record))
+        for additive in record.get("Additives", []):
+            if additive not in self.additives:
+                self.additives.append(additive)
+
+    def result(self):
+        record = dict(self.record)
+        if self.count > 1:
+            record["Band gap"] = sum(self.band_gaps) / len(self.band_gaps) if self.band_gaps else math.nan
+            record["Additives"] = self.additives
+        return record
+
+
+def deduplicate(records, writer, precision=6, partitions=64, temp_dir=None):
+    """Write every distinct composition in records once to writer (e.g. a JsonLinesWriter), with
+    duplicates merged. Memory use is about one partition of the records. The records are written
+    partition by partition, in the order they first appear within a partition. Returns a report"""
+    count = 0
+    with tempfile.TemporaryDirectory(dir=temp_dir) as folder_path:
+        spills = [JsonLinesWriter(os.path.join(folder_path, f"{i}.jsonl"), buffer_size=100, append=False)
+                  for i in range(partitions)]
+        try:
+            for record in records:
+                if hasattr(record, "to_dict"):
+                    record = record.to_dict()
+                key = record_key(record, precision)
+                partition = int(composition_hash(key)[:8], 16) % partitions
+                spills[partition].write([key, count, record])
+                count += 1
+        finally:
+            for spill in spills:
+                spill.close()
+
+        unique = 0
+        for spill in spills:
+            merged = {}
+            for key, order, record in read_json_lines(spill.file_path):
+                if key in merged:
+                    merged[key].add(record)
+                else:
+                    merged[key] = MergedRecord(record, order)
+            for group in sorted(merged.values(), key=lambda group: group.order):
+                writer.write(group.result())
+            unique += len(merged)
+            os.remove(spill.file_path)
+    return {"records": count, "unique": unique, "duplicates": count - unique}
+
+
+def deduplicate_json_lines(input_path, output_path, precision=6, partitions=64, temp_dir=None, backend="json"):
+    "Deduplicate a Json Lines file of perovskite records. Returns a report"
+    with JsonLinesWriter(output_path, append=False, backend=backend) as writer:
+        return deduplicate(read_json_lines(input_path), writer, precision=precision,
+                           partitions=partitions, temp_dir=temp_dir)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge duplicate compositions in a Json Lines file")
+    parser.add_argument("input", help="Json Lines file with perovskite records")
+    parser.add_argument("output", help="Json Lines file for the distinct compositions")
+    parser.add_argument("--precision", type=int, default=6, help="Decimals of the coefficients in the key")
+    parser.add_argument("--partitions", type=int, default=64, 
+                        help="Number of temporary files. More partitions use less memory")
+    args = parser.parse_args(argv)
+    report = deduplicate_json_lines(args.input, args.output, precision=args.precision, partitions=args.partitions)
+    print(f"{report['records']} records, {report['unique']} distinct compositions, "
+          f"{report['duplicates']} duplicates merged")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,265 @@
+"""
+Functionality for converting compositions in a long running local service
+
+Starting the service loads the ion reference tables once and keeps them, and
+the composition cache, in memory, so clients (notebooks, the GUI, scripts)
+do not pay for loading pandas and the Excel files before every conversion.
+The service speaks a small Json over HTTP API on a local TCP port or a Unix
+socket, and serves many clients at the same time with asyncio.
+
+    POST /convert   A composition, a list of compositions or {"compositions": [...]}.
+                    A composition has the arguments of PerovskiteToJson:
+                    {"A_ions": ["Cs", "FA"], "A_coef": [0.1, 0.9], "B_ions": ["Pb"],
+                     "B_coef": [1], "C_ions": ["I"], "C_coef": [3], "Eg": 1.55,
+                     "Dimensionality": "3D", "Additives": []}
+                    Ions, coefficients and additives may also be strings separated by ;
+                    Returns {"record": {...}} or {"records": [...]}, and "latency_ms"
+    GET /health     Status, number of requests and composition cache statistics
+
+Start with:
+    python conversion_service.py --port 8765
+    python conversion_service.py --unix /tmp/perovskite.sock
+
+and use from Python with:
+    client = ConversionClient(port=8765)
+    record = client.convert({"A_ions": "MA", "A_coef": "1", ...})
+"""
+
+import argparse
+import asyncio
+import http.client
+import json
+import socket
+import time
+
+import numpy as np
+
+from ion_reference import get_ion_table
+from perovskite_batch import parse_coefficient, split_cell
+from perovskite_to_json_v2 import PerovskiteToJson, composition_cache, path_a_ions, path_b_ions, path_c_ions
+from serializers import get_serializer
+
+# Batches at least this large are converted in a thread, so other clients are not kept waiting
+thread_batch_size = 200
+
+# Largest accepted request body, in bytes
+max_body_size = 64 * 1024 * 1024
+
+status_messages = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                   413: "Payload Too Large", 500: "Internal Server Error"}
+
+
+class RequestError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+def composition_arguments(composition):
+    "Arguments for PerovskiteToJson from a composition sent to the service"
+    if not isinstance(composition, dict):
+        raise RequestError(400, "A composition must be a Json object")
+    arguments = {}
+    for site in ("A", "B", "C"):
+        arguments[site + "_ions"] = [str(ion) for ion in split_cell(composition.get(site + "_ions", []))]
+        arguments[site + "_coef"] = [parse_coefficient(x) for x in split_cell(composition.get(site + "_coef", []))]
+    Eg = composition.get("Eg", composition.get("Band gap"))
+    arguments["Eg"] = np.nan if Eg is None else Eg
+    arguments["Dimensionality"] = composition.get("Dimensionality", "")
+    arguments["Additives"] = split_cell(composition.get("Additives", []))
+    return arguments
+
+
+def convert_compositions(compositions):
+    "Perovskite records (dictionaries) for a list of compositions"
+    return [PerovskiteToJson(**composition_arguments(composition), lazy=True).to_dict()
+            for composition in compositions]
+
+
+class ConversionService:
+    "Json over HTTP conversion service, on a TCP port or a Unix socket"
+    def __init__(self, backend="json"):
+        self.serializer = get_serializer(backend, pretty=False)
+        self.requests = 0
+        self.started = time.time()
+        self._server = None
+
+    def warm_up(self):
+        "Load the ion tables and convert one composition, so the first request is fast"
+        for file_path in (path_a_ions, path_b_ions, path_c_ions):
+            get_ion_table(file_path)
+        convert_compositions([{"A_ions": ["MA"], "A_coef": [1], "B_ions": ["Pb"], "B_coef": [1],
+                               "C_ions": ["I"], "C_coef": [3]}])
+
+    async def start(self, host="127.0.0.1", port=8765, unix_path=None):
+        self.warm_up()
+        if unix_path is not None:
+            self._server = await asyncio.start_unix_server(self.handle_client, path=unix_path)
+        else:
+            self._server = await asyncio.start_server(self.handle_client, host=host, port=port)
+        return self._server
+
+    async def serve_forever(self, host="127.0.0.1", port=8765, unix_path=None):
+        server = await self.start(host=host, port=port, unix_path=unix_path)
+        async with server:
+            await server.serve_forever()
+
+    def close(self):
+        if self._server is not None:
+            self._server.close()
+
+    async def handle_client(self, reader, writer):
+        "Serve the requests of one connection until the client closes it"
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                keep_alive = await self.handle_request(request_line, reader, writer)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    async def handle_request(self, request_line, reader, writer):
+        "Read, answer and time one request. Returns whether to keep the connection open"
+        start = time.perf_counter()
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+        keep_alive = headers.get("connection", "").lower() != "close"
+
+        try:
+            parts = request_line.decode("latin-1").split()
+            if len(parts) != 3:
+                raise RequestError(400, "Malformed request line")
+            method, path = parts[0], parts[1].split("?")[0]
+            length = int(headers.get("content-length", 0))
+            if length > max_body_size:
+                keep_alive = False
+                raise RequestError(413, "Request body is too large")
+            body = await reader.readexactly(length) if length else b""
+            self.requests += 1
+            result = await self.dispatch(method, path, body)
+            status = 200
+        except RequestError as error:
+            status, result = error.status, {"error": str(error)}
+        except ValueError as error:
+            status, result = 400, {"error": str(error)}
+        except Exception as error:
+            status, result = 500, {"error": f"{type(error).__name__}: {error}"}
+
+        latency = (time.perf_counter() - start) * 1000
+        result["latency_ms"] = latency
+        payload = self.serializer.dumpb(result)
+        writer.write((f"HTTP/1.1 {status} {status_messages.get(status, '')}\r\n"
+                      f"Content-Type: application/json\r\n"
+                      f"Content-Length: {len(payload)}\r\n"
+                      f"X-Latency-Ms: {latency:.3f}\r\n"
+                      f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n").encode("latin-1") + payload)
+        return keep_alive
+
+    async def dispatch(self, method, path, body):
+        if path == "/health":
+            return {"status": "ok", "requests": self.requests, "uptime_s": time.time() - self.started,
+                    "composition_cache": composition_cache.stats()}
+        if path != "/convert":
+            raise RequestError(404, f"Unknown path: {path}. Use /convert or /health")
+        if method != "POST":
+            raise RequestError(405, "Send compositions to /convert with POST")
+
+        data = json.loads(body or b"null")
+        if isinstance(data, dict) and "compositions" in data:
+            compositions, single = data["compositions"], False
+        elif isinstance(data, list):
+            compositions, single = data, False
+        else:
+            compositions, single = [data], True
+        if not isinstance(compositions, list):
+            raise RequestError(400, "compositions must be a list")
+
+        if len(compositions) >= thread_batch_size:
+            records = await asyncio.get_running_loop().run_in_executor(None, convert_compositions, compositions)
+        else:
+            records = convert_compositions(compositions)
+        return {"record": records[0]} if single else {"records": records}
+
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    "HTTP connection over a Unix socket"
+    def __init__(self, unix_path, timeout=60):
+        super().__init__("localhost", timeout=timeout)
+        self.unix_path = unix_path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.unix_path)
+
+
+class ConversionClient:
+    "Client for the conversion service, keeping one connection open"
+    def __init__(self, host="127.0.0.1", port=8765, unix_path=None, timeout=60):
+        if unix_path is not None:
+            self.connection = UnixHTTPConnection(unix_path, timeout=timeout)
+        else:
+            self.connection = http.client.HTTPConnection(host, port, timeout=timeout)
+        self.last_latency_ms = None
+
+    def request(self, method, path, data=None):
+        body = None if data is None else json.dumps(data).encode("utf-8")
+        self.connection.request(method, path, body=body, headers={"Content-Type": "application/json"})
+        response = self.connection.getresponse()
+        result = json.loads(response.read())
+        self.last_latency_ms = result.get("latency_ms")
+        if response.status != 200:
+            raise RuntimeError(f"Conversion service error {response.status}: {result.get('error')}")
+        return result
+
+    def convert(self, composition):
+        "The perovskite record of one composition"
+        return self.request("POST", "/convert", composition)["record"]
+
+    def convert_many(self, compositions):
+        "The perovskite records of a list of compositions"
+        return self.request("POST", "/convert", {"compositions": list(compositions)})["records"]
+
+    def health(self):
+        return self.request("GET", "/health")
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Local service converting perovskite compositions to Json records")
+    parser.add_argument("--host", default="127.0.0.1", help="Address to listen on")
+    parser.add_argument("--port", type=int, default=8765, help="TCP port to listen on")
+    parser.add_argument("--unix", help="Listen on this Unix socket instead of a TCP port")
+    parser.add_argument("--json-backend", default="json", help="Json serializer for the responses")
+    args = parser.parse_args(argv)
+
+    service = ConversionService(backend=args.json_backend)
+    where = args.unix if args.unix else f"http://{args.host}:{args.port}"
+    print(f"Serving perovskite conversions on {where}")
+    try:
+        asyncio.run(service.serve_forever(host=args.host, port=args.port, unix_path=args.unix))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+"""
+Functionality for searching a corpus of perovskite records
+
+CorpusIndex is built from records in the convert_to_json format. It has
+inverted indexes (value -> set of record ids) on the A, B and C ions, the
+SMILES, the CAS numbers, the perovskite family and the dimensionality, and a
+sorted index on the band gap for range queries. The index can be saved to
+disk as Json and loaded again instead of being rebuilt.
+
+Example:
+    index = CorpusIndex.from_folder("Data")
+    ids = index.query(ions=["FA", "Sn"], band_gap=(1.2, 1.4))
+    paths = index.locations(ids)
+"""
+
+import glob
+import json
+import math
+import os
+
+import numpy as np
+
+from record_writers import read_json_lines, replacing_file
+
+# Record fields in every inverted index
+indexed_fields = {
+    "A_ions": ("A_ions",),
+    "B_ions": ("B_ions",),
+    "C_ions": ("C_ions",),
+    "ions": ("A_ions", "B_ions", "C_ions"),
+    "SMILES": ("A_SMILES", "B_SMILES", "C_SMILES", "A_parent_SMILES", "B_parent_SMILES", "C_parent_SMILES"),
+    "CAS": ("A_cas_numbers", "B_cas_numbers", "C_cas_numbers",
+            "A_parent_cas_numbers", "B_parent_cas_numbers", "C_parent_cas_numbers"),
+    "family": ("Perovskite family",),
+    "dimensionality": ("Dimensionality",),
+}
+
+# Changed when the format of saved indexes changes
+index_version = 2
+
+# Placeholders for missing data, which are not indexed
+missing_values = {"NaN", "nan", ""}
+
+
+def band_gap_value(value):
+    "The band gap as a float, NaN if missing or not a number"
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return math.nan
+
+
+def indexed_values(record):
+    "Generator over (index name, value) for every value of a record that is indexed"
+    for name, fields in indexed_fields.items():
+        for field in fields:
+            values = record.get(field, [])
+            if not isinstance(values, list):
+                values = [values]
+            for value in values:
+                if value not in missing_values:
+                    yield name, value
+
+
+class CorpusIndex:
+    "Inverted and sorted indexes over a corpus of perovskite records"
+    def __init__(self):
+        self.inverted = {name: {} for name in indexed_fields}
+        self.band_gaps = []
+        self.compositions = []
+        self.location_list = []
+        self._sorted = None
+
+    def __len__(self):
+        return len(self.location_list)
+
+    def add(self, record, location=None):
+        "Index a record. location is where to find it again, e.g. a file path. Returns the record id"
+        record_id = len(self.location_list)
+        for name, value in indexed_values(record):
+            self.inverted[name].setdefault(value, set()).add(record_id)
+        self.band_gaps.append(band_gap_value(record.get("Band gap")))
+        self.compositions.append(record.get("Perovskite composition"))
+        self.location_list.append(location)
+        self._sorted = None
+        return record_id
+
+    def replace(self, record_id, old_record, new_record):
+        "Update the inverted indexes after a record has been changed in place, e.g. re-enriched"
+        old_values = set(indexed_values(old_record))
+        new_values = set(indexed_values(new_record))
+        for name, value in old_values - new_values:
+            postings = self.inverted[name].get(value)
+            if postings is None:
+                continue
+            postings.discard(record_id)
+            if not postings:
+                del self.inverted[name][value]
+        for name, value in new_values - old_values:
+            self.inverted[name].setdefault(value, set()).add(record_id)
+
+    def add_many(self, records, locations=None):
+        if locations is None:
+            locations = [None] * len(records)
+        for record, location in zip(records, locations):
+            self.add(record, location)
+
+    @classmethod
+    def from_records(cls, records, locations=None):
+        index = cls()
+        index.add_many(list(records), locations)
+        return index
+
+    @classmethod
+    def from_folder(cls, folder_path, pattern="*.json"):
+        "Index every Json file in a folder, with the file paths as locations"
+        index = cls()
+        for file_path in sorted(glob.glob(os.path.join(folder_path, pattern))):
+            with open(file_path) as infile:
+                index.add(json.load(infile), file_path)
+        return index
+
+    @classmethod
+    def from_json_lines(cls, file_path):
+        """Index a Json Lines file (gzip if the name ends with .gz), with the record numbers as
+        locations. Empty lines are not counted, so the numbers are those of IndexedJsonLines"""
+        index = cls()
+        for record_number, record in enumerate(read_json_lines(file_path)):
+            index.add(record, record_number)
+        return index
+
+    def sorted_band_gaps(self):
+        "Band gaps in increasing order and their record ids. Records without a band gap are left out"
+        if self._sorted is None:
+            gaps = np.asarray(self.band_gaps, dtype=float)
+            ids = np.flatnonzero(~np.isnan(gaps))
+            order = np.argsort(gaps[ids], kind="stable")
+            self._sorted = (gaps[ids][order], ids[order], gaps)
+        return self._sorted
+
+    def query(self, A_ions=None, B_ions=None, C_ions=None, ions=None, SMILES=None, CAS=None,
+              family=None, dimensionality=None, band_gap=None):
+        """Ids of the records matching every given condition, in increasing order.
+        Ions, SMILES and CAS numbers are lists that must all be present in a record.
+        band_gap is (low, high), inclusive, where either may be None"""
+        conditions = [("A_ions", A_ions), ("B_ions", B_ions), ("C_ions", C_ions), ("ions", ions),
+                      ("SMILES", SMILES), ("CAS", CAS), ("family", family), ("dimensionality", dimensionality)]
+        postings = []
+        for name, values in conditions:
+            if values is None:
+                continue
+            if isinstance(values, str):
+                values = [values]
+            for value in values:
+                postings.append(self.inverted[name].get(value, set()))
+
+        in_range = None
+        if band_gap is not None:
+            low, high = band_gap
+            low = -np.inf if low is None else low
+            high = np.inf if high is None else high
+            gaps_sorted, ids_sorted, gaps = self.sorted_band_gaps()
+            start = np.searchsorted(gaps_sorted, low, side="left")
+            stop = np.searchsorted(gaps_sorted, high, side="right")
+            in_range = ids_sorted[start:stop]
+
+        if not postings:
+            if in_range is None:
+                return list(range(len(self)))
+            return sorted(in_range.tolist())
+
+        # Start from the smallest set of records, the band gap range or the smallest posting
+        postings.sort(key=len)
+        if in_range is not None and len(in_range) <= len(postings[0]):
+            return sorted(i for i in in_range.tolist() if all(i in posting for posting in postings))
+
+        candidates = postings[0].intersection(*postings[1:])
+        if in_range is not None and candidates:
+            ids = np.fromiter(candidates, dtype=np.int64, count=len(candidates))
+            values = gaps[ids]
+            return sorted(ids[(values >= low) & (values <= high)].tolist())
+        return sorted(candidates)
+
+    def locations(self, ids):
+        "Where the records with these ids are found"
+        return [self.location_list[i] for i in ids]
+
+    def values(self, name):
+        "All indexed values for an index, e.g. every family in the corpus"
+        return sorted(self.inverted[name])
+
+    def save(self, file_path):
+        "Save the index so it does not have to be rebuilt"
+        # The inverted indexes as [value, record ids] pairs, as the values are not always strings
+        state = {"version": index_version,
+                 "inverted": {name: [[value, sorted(ids)] for value, ids in postings.items()]
+                              for name, postings in self.inverted.items()},
+                 "band_gaps": self.band_gaps, "compositions": self.compositions, "locations": self.location_list}
+        with replacing_file(file_path) as outfile:
+            outfile.write(json.dumps(state).encode("utf-8"))
+
+    @classmethod
+    def load(cls, file_path):
+        with open(file_path, "rb") as infile:
+            state = json.load(infile)
+        if not isinstance(state, dict) or state.get("version") != index_version:
+            raise ValueError(f"{file_path} is not a saved CorpusIndex, or was saved by another version")
+        index = cls()
+        index.inverted = {name: {value: set(ids) for value, ids in postings}
+                          for name, postings in state["inverted"].items()}
+        index.band_gaps = state["band_gaps"]
+        index.compositions = state["compositions"]
+        index.location_list = state["locations"]
+        return index
@@ -0,0 +1,236 @@
+"""
+Functionality for updating an existing corpus of perovskite records after the
+ion reference tables in Data_ions have been edited
+
+The content of the ion tables is saved next to the corpus (the ion state).
+When the tables change, the old and new tables are compared row by row on the
+Abbreviation, the records with a changed ion are found through the ion indexes
+of a CorpusIndex, and only their enrichment fields (SMILES, names, CAS numbers,
+...) are rewritten. Records with unchanged ions are not read or written.
+
+If no ion state has been saved for a corpus, the enrichment data the corpus
+was made with is read from the records themselves, from one record per ion,
+and compared with the current tables. The ion state is saved after every
+refresh.
+
+A corpus is either a folder with one .json file per record, indexed with
+CorpusIndex.from_folder, or a Json Lines file, indexed with
+CorpusIndex.from_json_lines. A Json Lines file is copied line by line, and
+only the changed lines are parsed and serialized again.
+
+Example:
+    save_ion_state("Data/ion_state.json")            # when the corpus is generated (optional)
+    ...                                              # edit Data_ions/A-ion_data.xlsx
+    refresh_corpus(index, "Data/ion_state.json")     # rewrites the affected files
+"""
+
+import argparse
+import gzip
+import json
+import os
+import time
+
+from corpus_index import CorpusIndex
+from ion_reference import get_ion_table
+from perovskite_batch import enrichment_fields, set_enrichment_fields, sites
+from perovskite_to_json_v2 import data_dict_keys, ion_data_dict, path_a_ions, path_b_ions, path_c_ions
+from record_writers import JsonFileWriter, iter_json_lines, open_lines, replacing_file
+from serializers import get_serializer
+
+
+def table_entries(ion_files=(path_a_ions, path_b_ions, path_c_ions)):
+    "The enrichment data of every ion, per site, as dictionaries from abbreviation to data"
+    return [dict(get_ion_table(file_path).index.items()) for file_path in ion_files]
+
+
+def save_ion_state(file_path, ion_files=(path_a_ions, path_b_ions, path_c_ions), entries=None):
+    "Save the current content of the ion tables, to compare with when they are edited"
+    if entries is None:
+        entries = table_entries(ion_files)
+    with replacing_file(file_path) as outfile:
+        outfile.write(json.dumps([{ion: list(entry) for ion, entry in site_entries.items()}
+                                  for site_entries in entries]).encode("utf-8"))
+
+
+def load_ion_state(file_path):
+    "The ion state saved with save_ion_state, in the format of table_entries"
+    with open(file_path, "rb") as infile:
+        state = json.load(infile)
+    return [{ion: tuple(entry) for ion, entry in site_entries.items()} for site_entries in state]
+
+
+def changed_ions(old_entries, new_entries):
+    "Abbreviations that were added, removed or have different data in the new table"
+    changed = set(old_entries.keys() ^ new_entries.keys())
+    for ion in old_entries.keys() & new_entries.keys():
+        if old_entries[ion] != new_entries[ion]:
+            changed.add(ion)
+    return sorted(changed)
+
+
+def record_fields(entry):
+    "The values of a table entry that are written to a record, in the order of enrichment_fields"
+    return tuple(entry[data_dict_keys.index(key)] for _, key in enrichment_fields)
+
+
+def read_records(index, ids, corpus_path=None):
+    "The records with some ids, read from their files or from a Json Lines file"
+    locations = index.locations(ids)
+    if corpus_path is None:
+        records = []
+        for file_path in locations:
+            with open(file_path) as infile:
+                records.append(json.load(infile))
+        return records
+    wanted = set(locations)
+    by_number = {}
+    with open_lines(corpus_path, "rb") as infile:
+        for record_number, line in iter_json_lines(infile):
+            if record_number in wanted:
+                by_number[record_number] = json.loads(line)
+    return [by_number[location] for location in locations]
+
+
+def corpus_entries(index, corpus_path=None):
+    """The enrichment data every ion in a corpus was written with, per site, as dictionaries from
+    ion to record_fields. Read from the first record with each ion"""
+    first_ids = [{ion: min(ids) for ion, ids in index.inverted[site + "_ions"].items()} for site in sites]
+    ids = sorted({i for site_ids in first_ids for i in site_ids.values()})
+    records = dict(zip(ids, read_records(index, ids, corpus_path)))
+    entries = []
+    for site, site_ids in zip(sites, first_ids):
+        site_entries = {}
+        for ion, i in site_ids.items():
+            record = records[i]
+            position = record[site + "_ions"].index(ion)
+            site_entries[ion] = tuple(record[f"{site}_{field}"][position] for field, _ in enrichment_fields)
+        entries.append(site_entries)
+    return entries
+
+
+def affected_records(index, changes):
+    "Ids of the records with a changed ion on the site where it changed"
+    ids = set()
+    for site, ions in zip(sites, changes):
+        postings = index.inverted[site + "_ions"]
+        for ion in ions:
+            ids.update(postings.get(ion, ()))
+    return sorted(ids)
+
+
+def reenrich(record, tables):
+    "Record with the enrichment fields filled from the ion tables. The other fields are kept"
+    record = dict(record)
+    for site, table in zip(sites, tables):
+        set_enrichment_fields(record, site, ion_data_dict(table, record[site + "_ions"]))
+    return record
+
+
+def refresh_json_lines(file_path, record_numbers, tables, backend="json"):
+    """Rewrite the records with the given numbers (see CorpusIndex.from_json_lines) in a Json Lines
+    file with re-enriched records. Returns the (record number, old record, new record) of every
+    rewritten record"""
+    serializer = get_serializer(backend, pretty=False)
+    record_numbers = set(record_numbers)
+    updates = []
+    record_number = 0
+    with open_lines(file_path, "rb") as infile, replacing_file(file_path) as temp_file:
+        # The temporary file has no .gz ending, so compress it here for .gz corpora
+        outfile = gzip.GzipFile(fileobj=temp_file, mode="wb") if str(file_path).endswith(".gz") else temp_file
+        with outfile:
+            for line in infile:
+                if line.strip():
+                    if record_number in record_numbers:
+                        old_record = json.loads(line)
+                        new_record = reenrich(old_record, tables)
+                        line = serializer.dumpb(new_record) + b"\n"
+                        updates.append((record_number, old_record, new_record))
+                    record_number += 1
+                outfile.write(line)
+    return updates
+
+
+def refresh_files(file_paths, tables, max_workers=8):
+    """Rewrite Json files, one record each, with re-enriched records.
+    Returns the (file path, old record, new record) of every rewritten file"""
+    updates = []
+    with JsonFileWriter(max_workers=max_workers) as writer:
+        for file_path in file_paths:
+            with open(file_path) as infile:
+                old_record = json.load(infile)
+            new_record = reenrich(old_record, tables)
+            writer.write(new_record, file_path)
+            updates.append((file_path, old_record, new_record))
+    if writer.errors:
+        raise writer.errors[0]
+    return updates
+
+
+def refresh_corpus(index, state_path, corpus_path=None, ion_files=(path_a_ions, path_b_ions, path_c_ions),
+                   index_path=None, max_workers=8):
+    """Rewrite the enrichment fields of the records affected by edits to the ion tables since the
+    ion state was saved, or that differ from the records if there is no ion state, and save the
+    new ion state. corpus_path is the Json Lines file for an index made with
+    CorpusIndex.from_json_lines, and not needed for a folder of Json files. The index is updated, and saved to index_path if given. Returns a report"""
+    start = time.perf_counter()
+    tables = [get_ion_table(file_path) for file_path in ion_files]
+    new_entries = [dict(table.index.items()) for table in tables]
+    state_created = not os.path.exists(state_path)
+    if state_created:
+        # Compare what the records hold with what the current tables would give them
+        old_entries = corpus_entries(index, corpus_path)
+        changes = [changed_ions(old, {ion: record_fields(table.lookup(ion)) for ion in old})
+                   for old, table in zip(old_entries, tables)]
+    else:
+        old_entries = load_ion_state(state_path)
+        changes = [changed_ions(old, new) for old, new in zip(old_entries, new_entries)]
+    ids = affected_records(index, changes)
+    locations = index.locations(ids)
+
+    if ids and corpus_path is not None:
+        updates = refresh_json_lines(corpus_path, locations, tables)
+    else:
+        updates = refresh_files(locations, tables, max_workers=max_workers)
+
+    id_by_location = dict(zip(locations, ids))
+    for location, old_record, new_record in updates:
+        index.replace(id_by_location[location], old_record, new_record)
+    if index_path is not None:
+        index.save(index_path)
+    save_ion_state(state_path, entries=new_entries)
+    return {"changed_ions": dict(zip(sites, changes)), "records": len(updates),
+            "seconds": time.perf_counter() - start, "state_created": state_created}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Update a corpus of perovskite records after the "
+                                     "ion reference tables have been edited")
+    parser.add_argument("corpus", help="Folder with one .json file per record, or a .jsonl file")
+    parser.add_argument("--index", help="Saved CorpusIndex. Built from the corpus if it does not exist")
+    parser.add_argument("--state", help="Saved ion state. Default: ion_state.json in the folder, "
+                        "or next to the .jsonl file")
+    parser.add_argument("--workers", type=int, default=8, help="Number of files written at the same time")
+    args = parser.parse_args(argv)
+
+    is_folder = os.path.isdir(args.corpus)
+    state_path = args.state
+    if state_path is None:
+        state_path = os.path.join(args.corpus, "ion_state.json") if is_folder else args.corpus + ".ion_state.json"
+    if args.index is not None and os.path.exists(args.index):
+        index = CorpusIndex.load(args.index)
+    elif is_folder:
+        index = CorpusIndex.from_folder(args.corpus)
+    else:
+        index = CorpusIndex.from_json_lines(args.corpus)
+
+    report = refresh_corpus(index, state_path, corpus_path=None if is_folder else args.corpus,
+                            index_path=args.index, max_workers=args.workers)
+    if report["state_created"]:
+        print(f"No ion state found. Compared the records with the ion tables, and saved the state to {state_path}")
+    for site in sites:
+        print(f"{site}-ions changed: {', '.join(report['changed_ions'][site]) or '-'}")
+    print(f"Records updated: {report['records']} in {report['seconds']:.2f} s")
+
+
+if __name__ == "__main__":
+    main()
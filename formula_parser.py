@@ -0,0 +1,187 @@
+"""
+Functionality for parsing perovskite formulas back to ions and coefficients
+
+The long formula made by PerovskiteToJson.get_long_formula, e.g.
+"Cs0.05FA0.18MA0.79PbBr0.5I2.5", is parsed into the A, B and C ions and their
+coefficients. Ions are recognised from the abbreviations in the ion reference
+tables, with the longest match tried first and backtracking when the rest of
+the formula cannot be parsed. Ions with more than two letters are enclosed in
+parentheses, ions with a coefficient of one have no coefficient, and the ions
+of every site are in alphabetic order. Short formulas (the perovskite family)
+are parsed the same way, with all coefficients set to one. An ion found in
+more than one table (e.g. La) is put on the first site where the rest of the
+formula can still be parsed. Enclosed ions that are in none of the tables are
+accepted on the current site.
+
+Results are memoized, as the same formulas are repeated many times in real
+datasets.
+"""
+
+import math
+import re
+from functools import lru_cache
+
+from ion_reference import get_ion_table
+from perovskite_to_json_v2 import enclose_ion, path_a_ions, path_b_ions, path_c_ions
+
+sites = ("A", "B", "C")
+
+# A coefficient as written by coefficient_string, e.g. 0.05, 2.5, 3, 1e-05 or nan
+coefficient_pattern = re.compile(r"(?:\d+(?:\.\d*)?|\.\d+)(?:[eE][-+]?\d+)?|nan")
+
+
+class IonTrie:
+    "Prefix tree of the ions of one site, as they are written in the formula"
+    def __init__(self, ions):
+        self.root = {}
+        for ion in ions:
+            node = self.root
+            for character in enclose_ion(ion):
+                node = node.setdefault(character, {})
+            node[None] = ion
+
+    def matches(self, formula, start):
+        "All ions at a position in the formula, as (ion, end), longest first"
+        found = []
+        node = self.root
+        for position in range(start, len(formula)):
+            node = node.get(formula[position])
+            if node is None:
+                break
+            if None in node:
+                found.append((node[None], position + 1))
+        found.reverse()
+        return found
+
+
+def enclosed_ion_at(formula, start):
+    "An ion enclosed in parentheses that is not in the tables, as (ion, end), or None"
+    if formula[start] != "(":
+        return None
+    depth = 0
+    for position in range(start, len(formula)):
+        if formula[position] == "(":
+            depth += 1
+        elif formula[position] == ")":
+            depth -= 1
+            if depth == 0:
+                return formula[start+1:position], position + 1
+    return None
+
+
+def coefficient_value(text):
+    "The number for a coefficient string. No coefficient means one"
+    if text == "":
+        return 1
+    if text == "nan":
+        return math.nan
+    if re.fullmatch(r"\d+", text):
+        return int(text)
+    return float(text)
+
+
+class FormulaParser:
+    "Parse formulas using the abbreviations of the A, B and C ion tables"
+    def __init__(self, a_ions, b_ions, c_ions, maxsize=100000):
+        self.tries = [IonTrie(ions) for ions in (a_ions, b_ions, c_ions)]
+        self.known_ions = set(a_ions) | set(b_ions) | set(c_ions)
+        self._parse_cached = lru_cache(maxsize=maxsize)(self._parse)
+
+    def parse(self, formula):
+        "A dictionary with A_ions, A_coef, B_ions, B_coef, C_ions and C_coef for a formula"
+        parsed = self._parse_cached(formula.strip())
+        result = {}
+        for site, (ions, coef) in zip(sites, parsed):
+            result[site + "_ions"] = list(ions)
+            result[site + "_coef"] = list(coef)
+        return result
+
+    def cache_info(self):
+        return self._parse_cached.cache_info()
+
+    def cache_clear(self):
+        self._parse_cached.cache_clear()
+
+    def _parse(self, formula):
+        # Prefer a parse where every site has at least one ion
+        for require_all_sites in (True, False):
+            failed = set()
+            parsed = self._search(formula, 0, 0, [([], []), ([], []), ([], [])], require_all_sites, failed)
+            if parsed is not None:
+                return tuple((tuple(ions), tuple(coef)) for ions, coef in parsed)
+        raise ValueError(f"Could not parse perovskite formula: {formula}")
+
+    def _search(self, formula, start, site, parsed, require_all_sites, failed):
+        "Depth first search over ions and coefficients, backtracking on failure"
+        ions = parsed[site][0]
+        state = (start, site, ions[-1] if ions else None, tuple(len(p[0]) > 0 for p in parsed))
+        if state in failed:
+            return None
+
+        if start == len(formula):
+            if not require_all_sites or all(p[0] for p in parsed):
+                return [(list(i), list(c)) for i, c in parsed]
+            failed.add(state)
+            return None
+
+        # Continue with another ion on the same site. Ions within a site are sorted
+        candidates = self.tries[site].matches(formula, start)
+        unknown = enclosed_ion_at(formula, start)
+        if unknown is not None and unknown[0] not in self.known_ions:
+            candidates.append(unknown)
+        for ion, end in candidates:
+            if ions and ion < ions[-1]:
+                continue
+            for coef_text, coef_end in self._coefficients(formula, end):
+                parsed[site][0].append(ion)
+                parsed[site][1].append(coefficient_value(coef_text))
+                result = self._search(formula, coef_end, site, parsed, require_all_sites, failed)
+                parsed[site][0].pop()
+                parsed[site][1].pop()
+                if result is not None:
+                    return result
+
+        # Move on to the next site
+        if site < 2:
+            result = self._search(formula, start, site + 1, parsed, require_all_sites, failed)
+            if result is not None:
+                return result
+
+        failed.add(state)
+        return None
+
+    def _coefficients(self, formula, start):
+        "Possible coefficients after an ion, longest first, ending with no coefficient"
+        options = []
+        match = coefficient_pattern.match(formula, start)
+        if match:
+            text = match.group()
+            if text == "nan":
+                options.append((text, match.end()))
+            else:
+                # A coefficient may be followed by an ion starting with a digit, e.g. 4T
+                for end in range(match.end(), start, -1):
+                    if coefficient_pattern.fullmatch(formula, start, end):
+                        options.append((formula[start:end], end))
+        options.append(("", start))
+        return options
+
+
+_parsers = {}
+
+
+def get_formula_parser(ion_files=(path_a_ions, path_b_ions, path_c_ions)):
+    "A parser for the current ion tables. A new parser is made if a table has changed"
+    tables = [get_ion_table(file_path) for file_path in ion_files]
+    key = tuple((table.file_path, table.stamp) for table in tables)
+    parser = _parsers.get(tuple(ion_files))
+    if parser is None or parser.key != key:
+        parser = FormulaParser(*[list(table.index) for table in tables])
+        parser.key = key
+        _parsers[tuple(ion_files)] = parser
+    return parser
+
+
+def parse_long_formula(formula, ion_files=(path_a_ions, path_b_ions, path_c_ions)):
+    "Ions and coefficients for a long formula, e.g. Cs0.05FA0.18MA0.79PbBr0.5I2.5"
+    return get_formula_parser(ion_files).parse(formula)
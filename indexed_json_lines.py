@@ -0,0 +1,209 @@
+"""
+Functionality for random access to records in a large Json Lines file
+
+IndexedJsonLines memory maps a .jsonl file of perovskite records (e.g. made
+with JsonLinesWriter) and keeps a sidecar index, saved next to it as
+<file>.idx, with the byte offset of every record, the record number of every
+Perovskite composition and a code for the Perovskite family of every record.
+The index is an .npz archive of NumPy arrays with the names and the file stamp
+as Json, and is loaded without pickle, so an index file can not run code.
+Fetching a record, or all records of a composition, only decodes those lines.
+Iterating with a family filter skips the other lines without decoding them.
+
+The index is built without decoding the records, and is rebuilt when the
+Json Lines file has changed. Record numbers count the non-empty lines.
+Compressed (.gz) files can not be memory mapped, and are not supported.
+
+Example:
+    with IndexedJsonLines("Data/compositions.jsonl") as corpus:
+        record = corpus[87000]
+        records = corpus.find("CsPbI3")
+        for record in corpus.iter_records(family=["CsPbI", "FAPbI"]):
+            ...
+"""
+
+import json
+import mmap
+import re
+
+import numpy as np
+
+from ion_reference import file_stamp
+from record_writers import replacing_file
+
+index_version = 2
+
+# The string fields that are indexed, found without decoding the records
+family_pattern = re.compile(rb'"Perovskite family"\s*:\s*"((?:[^"\\\n]|\\.)*)"')
+composition_pattern = re.compile(rb'"Perovskite composition"\s*:\s*"((?:[^"\\\n]|\\.)*)"')
+
+
+def index_path_for(file_path):
+    return str(file_path) + ".idx"
+
+
+def decode_string(raw):
+    "A Json string value, without the quotes, as text"
+    if b"\\" in raw:
+        return json.loads(b'"' + raw + b'"')
+    return raw.decode("utf-8")
+
+
+def first_match_per_line(pattern, buffer, starts, ends):
+    "The decoded value of the first match of the pattern on every line, None where there is none"
+    values = [None] * len(starts)
+    matches = list(pattern.finditer(buffer))
+    positions = np.fromiter((match.start() for match in matches), dtype=np.int64, count=len(matches))
+    lines = np.searchsorted(starts, positions, side="right") - 1
+    for match, line in zip(matches, lines.tolist()):
+        if line >= 0 and match.end() <= ends[line] and values[line] is None:
+            values[line] = decode_string(match.group(1))
+    return values
+
+
+def build_index(buffer):
+    "Offsets, families and compositions of the records in a Json Lines buffer"
+    data = np.frombuffer(buffer, dtype=np.uint8)
+    newlines = np.flatnonzero(data == ord("\n"))
+    del data
+    starts = np.concatenate(([0], newlines + 1)).astype(np.int64)
+    ends = np.concatenate((newlines, [len(buffer)])).astype(np.int64)
+    keep = ends > starts
+    starts, ends = starts[keep], ends[keep]
+
+    families = first_match_per_line(family_pattern, buffer, starts, ends)
+    compositions = first_match_per_line(composition_pattern, buffer, starts, ends)
+
+    family_names = []
+    family_codes = {}
+    codes = np.empty(len(starts), dtype=np.int32)
+    for i, family in enumerate(families):
+        code = family_codes.get(family)
+        if code is None:
+            code = family_codes[family] = len(family_names)
+            family_names.append(family)
+        codes[i] = code
+
+    by_composition = {}
+    for i, composition in enumerate(compositions):
+        if composition is not None:
+            by_composition.setdefault(composition, []).append(i)
+    return {"starts": starts, "ends": ends, "family_codes": codes, "families": family_names,
+            "compositions": by_composition}
+
+
+class IndexedJsonLines:
+    "Memory mapped Json Lines file of perovskite records with a sidecar offset index"
+    def __init__(self, file_path, index_path=None, rebuild=False):
+        if str(file_path).endswith(".gz"):
+            raise ValueError("Compressed Json Lines files can not be memory mapped. Decompress it first")
+        self.file_path = file_path
+        self.index_path = index_path_for(file_path) if index_path is None else index_path
+        self._file = open(file_path, "rb")
+        stamp = file_stamp(file_path)
+        # Empty files can not be memory mapped
+        self._buffer = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if stamp[1] > 0 else b""
+
+        index = None if rebuild else self._load_index(stamp)
+        if index is None:
+            index = build_index(self._buffer)
+            self._save_index(stamp, index)
+        self.starts = index["starts"]
+        self.ends = index["ends"]
+        self.family_codes = index["family_codes"]
+        self.family_names = index["families"]
+        self.compositions = index["compositions"]
+
+    def _load_index(self, stamp):
+        "The saved index, or None if it is missing, out of date or can not be read"
+        try:
+            with np.load(self.index_path, allow_pickle=False) as archive:
+                metadata = json.loads(archive["metadata"].tobytes())
+                if metadata["version"] != index_version or metadata["stamp"] != list(stamp):
+                    return None
+                numbers = np.split(archive["composition_numbers"], np.cumsum(archive["composition_counts"])[:-1])
+                return {"starts": archive["starts"], "ends": archive["ends"], "family_codes": archive["family_codes"],
+                        "families": metadata["families"],
+                        "compositions": {composition: record_numbers.tolist() for composition, record_numbers
+                                         in zip(metadata["compositions"], numbers)}}
+        except Exception:
+            return None
+
+    def _save_index(self, stamp, index):
+        compositions = index["compositions"]
+        metadata = {"version": index_version, "stamp": list(stamp), "families": index["families"],
+                    "compositions": list(compositions)}
+        numbers = list(compositions.values())
+        try:
+            with replacing_file(self.index_path) as outfile:
+                np.savez(outfile, starts=index["starts"], ends=index["ends"], family_codes=index["family_codes"],
+                         composition_numbers=np.array([i for record_numbers in numbers for i in record_numbers],
+                                                      dtype=np.int64),
+                         composition_counts=np.array([len(record_numbers) for record_numbers in numbers],
+                                                     dtype=np.int64),
+                         metadata=np.frombuffer(json.dumps(metadata).encode("utf-8"), dtype=np.uint8))
+        except OSError:
+            # A read only folder. The index is then rebuilt every time
+            pass
+
+    def __len__(self):
+        return len(self.starts)
+
+    def raw(self, number):
+        "The undecoded bytes of a record"
+        return self._buffer[self.starts[number]:self.ends[number]]
+
+    def __getitem__(self, number):
+        if number < 0:
+            number += len(self)
+        if not 0 <= number < len(self):
+            raise IndexError(f"Record {number} is out of range, the file has {len(self)} records")
+        return json.loads(self.raw(number))
+
+    def get_many(self, numbers):
+        return [self[number] for number in numbers]
+
+    def find(self, composition):
+        "All records with a Perovskite composition, e.g. CsPbI3"
+        return self.get_many(self.compositions.get(composition, []))
+
+    def families(self):
+        "Every Perovskite family in the file"
+        return sorted(family for family in self.family_names if family is not None)
+
+    def family_numbers(self, family):
+        """Numbers of the records in some families. family is a family name, a list of names or
+        a function that is given a family name and returns True for the families to keep"""
+        if callable(family):
+            keep = [code for code, name in enumerate(self.family_names) if name is not None and family(name)]
+        else:
+            names = {family} if isinstance(family, str) else set(family)
+            keep = [code for code, name in enumerate(self.family_names) if name in names]
+        return np.flatnonzero(np.isin(self.family_codes, keep))
+
+    def iter_records(self, family=None, where=None, start=0, stop=None):
+        """Generator over the records from start to stop. Only records in the families given by
+        family (see family_numbers) are decoded, and where(record) can filter them further"""
+        if family is None:
+            numbers = range(start, len(self) if stop is None else min(stop, len(self)))
+        else:
+            numbers = self.family_numbers(family)
+            numbers = numbers[(numbers >= start) & (numbers < (len(self) if stop is None else stop))]
+        for number in numbers:
+            record = json.loads(self.raw(number))
+            if where is None or where(record):
+                yield record
+
+    def __iter__(self):
+        return self.iter_records()
+
+    def close(self):
+        if isinstance(self._buffer, mmap.mmap):
+            self._buffer.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
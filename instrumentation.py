@@ -0,0 +1,86 @@
+"""
+Functionality for measuring where time goes in the perovskite conversion
+
+The shared stats object records the wall time and number of calls for every
+timed stage (sort_ions, get_short_formula, get_long_formula,
+get_ion_complementary_data, convert_to_json, save_data), and counters such as
+unknown ions and cache hits. It is off by default, and then only costs an
+attribute check per call. Turn it on with stats.enable(), or by setting the
+environment variable PEROVSKITE_STATS=1.
+
+Example:
+    stats.enable()
+    PerovskiteToJson(...)
+    print(stats.snapshot())
+    stats.dump("stats.json")
+"""
+
+import functools
+import json
+import os
+import threading
+import time
+
+
+class Stats:
+    "Wall time and calls per stage, and named counters"
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._stages = {}
+        self._counters = {}
+
+    def enable(self):
+        self.enabled = True
+
+    def disable(self):
+        self.enabled = False
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+            self._counters = {}
+
+    def add_time(self, stage, seconds):
+        with self._lock:
+            calls, total = self._stages.get(stage, (0, 0.0))
+            self._stages[stage] = (calls + 1, total + seconds)
+
+    def count(self, counter, n=1):
+        if not self.enabled:
+            return
+        with self._lock:
+            self._counters[counter] = self._counters.get(counter, 0) + n
+
+    def snapshot(self):
+        "The current numbers as a dictionary"
+        with self._lock:
+            stages = {stage: {"calls": calls, "seconds": seconds,
+                              "us_per_call": seconds / calls * 1e6 if calls else 0.0}
+                      for stage, (calls, seconds) in self._stages.items()}
+            return {"stages": stages, "counters": dict(self._counters)}
+
+    def dump(self, file_path):
+        "Save a snapshot as Json"
+        with open(file_path, "w") as outfile:
+            json.dump(self.snapshot(), outfile, indent=4)
+
+
+# The shared stats used by the conversion code
+stats = Stats(enabled=os.environ.get("PEROVSKITE_STATS", "") not in ("", "0"))
+
+
+def timed(stage):
+    "Decorator that adds the wall time of every call to a stage, when stats are enabled"
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not stats.enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                stats.add_time(stage, time.perf_counter() - start)
+        return wrapper
+    return decorator
@@ -0,0 +1,221 @@
+"""
+Functionality for loading the ion reference tables in Data_ions
+
+The tables are read once per process and shared between all users.
+A table is re-read automatically if the file on disk changes (modification
+time or size), and can be reloaded or dropped explicitly.
+
+Reading the xlsx files with openpyxl is slow, so every table is also stored
+as a binary snapshot (a pickle next to the xlsx file, e.g. A-ion_data.pkl)
+of its abbreviations and their enrichment fields, as plain Python objects.
+Loading a snapshot does not need pandas. The snapshot is used when it was
+made from the current version of the xlsx file, and is rebuilt automatically
+when the xlsx file has changed or when a table is reloaded. Run this file as
+a script to compile the snapshots for Data_ions.
+
+The registry can also be given a store, e.g. the SQLite IonStore in
+ion_store, which then serves the tables it has instead of the xlsx files.
+"""
+
+import os
+import pickle
+import sys
+import threading
+
+from instrumentation import stats
+from record_writers import replacing_file
+
+# The columns used to enrich an ion, in the order returned by lookup
+enrichment_columns = ("Common_name", "IUPAC_name", "SMILE", "Molecular_formula", 
+                      "CAS", "Parent_SMILE", "Parent_IUPAC", "Parent_CAS")
+
+# Returned for ions that are not in the table
+missing_entry = ("NaN",) * len(enrichment_columns)
+
+# Changed when the content of the snapshots changes, so old snapshots are rebuilt
+snapshot_version = 2
+
+
+def build_index(data):
+    """Map every abbreviation in a table (a DataFrame) to its enrichment fields. If not unique, 
+    the first row is used. Returns the index and all abbreviations in table order"""
+    columns = [data[column].values for column in enrichment_columns]
+    abbreviations = [x for x in data["Abbreviation"].tolist() if isinstance(x, str)]
+    index = {}
+    for row, abbreviation in enumerate(data["Abbreviation"].values):
+        if not isinstance(abbreviation, str) or abbreviation in index:
+            continue
+        index[abbreviation] = tuple(str(column[row]).strip() for column in columns)
+    return index, abbreviations
+
+
+class IonReferenceTable:
+    "One loaded ion reference table, e.g. A-ion_data.xlsx"
+    def __init__(self, file_path, index, abbreviation_list, stamp):
+        self.file_path = file_path
+        self.index = index
+        self.abbreviation_list = abbreviation_list
+        self.stamp = stamp
+
+    def lookup(self, ion):
+        "All enrichment fields for one ion, or NaN for ions not in the table"
+        return self.index.get(ion, missing_entry)
+
+    def lookup_many(self, ions):
+        "Enrichment fields for a list of ions"
+        index = self.index
+        return [index.get(ion, missing_entry) for ion in ions]
+
+    def abbreviations(self):
+        "All abbreviations in the table, in table order. Rows without an abbreviation are left out"
+        return list(self.abbreviation_list)
+
+
+class IonReferenceRegistry:
+    "Process-wide cache of ion reference tables, keyed by file path"
+    def __init__(self):
+        self._tables = {}
+        self._store = None
+        self._lock = threading.RLock()
+
+    def use_store(self, store):
+        """Get tables from a store with a table_for(file_path) method, e.g. an IonStore, instead of
+        reading the files. Files the store has no table for are still read. None turns it off"""
+        with self._lock:
+            self._store = store
+
+    @property
+    def store(self):
+        "The store set with use_store, or None"
+        return self._store
+
+    def get(self, file_path):
+        "Get the table for a file, reading it if not cached or if the file has changed"
+        store = self._store
+        if store is not None:
+            table = store.table_for(file_path)
+            if table is not None:
+                return table
+        file_path = os.path.abspath(file_path)
+        stamp = file_stamp(file_path)
+        with self._lock:
+            table = self._tables.get(file_path)
+            if table is None or table.stamp != stamp:
+                table = self._load(file_path, stamp)
+            else:
+                stats.count("ion_table_cache_hits")
+            return table
+
+    def reload(self, file_path=None):
+        "Re-read one table, or all cached tables if no file is given, from the file and not the snapshot"
+        with self._lock:
+            if file_path is None:
+                file_paths = list(self._tables)
+            else:
+                file_paths = [os.path.abspath(file_path)]
+            for path in file_paths:
+                self._load(path, file_stamp(path), use_snapshot=False)
+
+    def clear(self, file_path=None):
+        "Drop one table, or all tables, from the cache"
+        with self._lock:
+            if file_path is None:
+                self._tables.clear()
+            else:
+                self._tables.pop(os.path.abspath(file_path), None)
+
+    def cached_files(self):
+        "Paths of the tables currently in the cache"
+        with self._lock:
+            return list(self._tables)
+
+    def _load(self, file_path, stamp, use_snapshot=True):
+        table = read_ion_table(file_path, stamp, use_snapshot=use_snapshot)
+        self._tables[file_path] = table
+        return table
+
+
+def read_ion_table(file_path, stamp=None, use_snapshot=True):
+    """Read a table from its snapshot, or from the xlsx file if there is no current snapshot or
+    use_snapshot is False. The snapshot is rewritten when the xlsx file is read"""
+    if stamp is None:
+        stamp = file_stamp(file_path)
+    snapshot = load_snapshot(file_path, stamp) if use_snapshot else None
+    if snapshot is None:
+        index, abbreviations = read_xlsx_table(file_path)
+        save_snapshot(file_path, stamp, index, abbreviations)
+        stats.count("ion_table_xlsx_loads")
+    else:
+        index, abbreviations = snapshot
+        stats.count("ion_table_snapshot_loads")
+    return IonReferenceTable(file_path, index, abbreviations, stamp)
+
+
+def read_xlsx_table(file_path):
+    "The index and abbreviations of an xlsx table"
+    # pandas is only imported when an xlsx file is read, which is slow anyway
+    import pandas as pd
+    return build_index(pd.read_excel(file_path))
+
+
+def file_stamp(file_path):
+    "Modification time and size of a file, used to detect changes"
+    stat = os.stat(file_path)
+    return (stat.st_mtime_ns, stat.st_size)
+
+
+def snapshot_path(file_path):
+    "Path to the binary snapshot of an ion reference table"
+    return os.path.splitext(file_path)[0] + ".pkl"
+
+
+def load_snapshot(file_path, stamp):
+    """The index and abbreviations from the snapshot of a table, or None if there is no snapshot 
+    for this version of the file. Snapshots that can not be read are treated as out of date"""
+    try:
+        with open(snapshot_path(file_path), "rb") as infile:
+            snapshot = pickle.load(infile)
+        if snapshot.get("version") != snapshot_version or snapshot.get("stamp") != stamp:
+            return None
+        return snapshot["index"], snapshot["abbreviations"]
+    except Exception:
+        return None
+
+
+def save_snapshot(file_path, stamp, index, abbreviations):
+    "Store a table as a snapshot. Skipped if the folder is not writable"
+    snapshot = {"version": snapshot_version, "stamp": stamp, "index": index, "abbreviations": abbreviations}
+    try:
+        with replacing_file(snapshot_path(file_path)) as outfile:
+            pickle.dump(snapshot, outfile, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError:
+        pass
+
+
+def compile_snapshots(file_paths):
+    "Build fresh snapshots for the given xlsx files"
+    for file_path in file_paths:
+        file_path = os.path.abspath(file_path)
+        save_snapshot(file_path, file_stamp(file_path), *read_xlsx_table(file_path))
+
+
+# The shared registry used by PerovskiteToJson and the GUI
+ion_registry = IonReferenceRegistry()
+
+
+def get_ion_table(file_path):
+    "Get a cached ion reference table from the shared registry"
+    return ion_registry.get(file_path)
+
+
+# Compile the snapshots
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        file_paths = sys.argv[1:]
+    else:
+        folder = os.path.join(os.getcwd(), "Data_ions")
+        file_paths = [os.path.join(folder, name) for name in 
+                      ("A-ion_data.xlsx", "B-ion_data.xlsx", "C-ion_data.xlsx")]
+    compile_snapshots(file_paths)
+    for file_path in file_paths:
+        print(snapshot_path(file_path))
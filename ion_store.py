@@ -0,0 +1,327 @@
+"""
+Functionality for keeping the ion reference tables in a SQLite database
+
+IonStore holds the A, B and C ion tables in one SQLite file, indexed on the
+abbreviation, and on the SMILES and CAS numbers for reverse lookups. Ions
+are looked up in the database when needed, with one IN (...) query for a
+whole list of ions, so the tables are never loaded into memory and memory
+use does not grow with the number of ions. Ions can be added, changed and
+removed without editing the xlsx files.
+
+The store is filled from the xlsx files in Data_ions, with the same content
+as the tables read by ion_reference. After use_ion_store, get_ion_table,
+and with it PerovskiteToJson, the batch conversion and the GUI, use the
+store instead of the xlsx files.
+
+Example:
+    store = IonStore("ions.sqlite")
+    store.import_xlsx("Data_ions/A-ion_data.xlsx")      # or run this file as a script
+    store.find_smiles("C[NH3+]")                        # [("A", "MA")]
+    use_ion_store("ions.sqlite")
+"""
+
+import argparse
+import os
+import re
+import sqlite3
+import threading
+from collections.abc import Mapping
+
+from ion_reference import enrichment_columns, ion_registry, missing_entry, read_ion_table
+
+# Largest number of ions in one IN (...) query, below the SQLite limit on query parameters
+max_query_ions = 500
+
+schema = f"""
+CREATE TABLE IF NOT EXISTS sites (
+    site TEXT PRIMARY KEY,
+    file_name TEXT,
+    version INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS ions (
+    site TEXT NOT NULL,
+    Abbreviation TEXT NOT NULL,
+    position INTEGER NOT NULL,
+    {", ".join(f"{column} TEXT" for column in enrichment_columns)},
+    PRIMARY KEY (site, Abbreviation)
+);
+CREATE INDEX IF NOT EXISTS ions_smile ON ions (SMILE);
+CREATE INDEX IF NOT EXISTS ions_cas ON ions (CAS);
+"""
+
+field_list = ", ".join(enrichment_columns)
+
+
+def site_from_file_name(file_path):
+    "The site of an ion table file, e.g. A for A-ion_data.xlsx"
+    name = os.path.basename(str(file_path))
+    match = re.match(r"([A-Za-z])-ion_data", name)
+    return match.group(1).upper() if match else os.path.splitext(name)[0]
+
+
+class StoreIndex(Mapping):
+    """The abbreviations of one site and their enrichment fields, read from the store when needed.
+    Iterating reads the whole site with one query, and keeps it until the site is changed, so
+    e.g. dict(index) does not make one query per ion"""
+    def __init__(self, store, site):
+        self.store = store
+        self.site = site
+        self._entries = None
+        self._version = None
+
+    def entries(self):
+        "Every ion of the site and its enrichment fields, as a dictionary in table order"
+        version = self.store.version(self.site)
+        if self._entries is None or self._version != version:
+            self._entries = dict(self.store.entries(self.site))
+            self._version = version
+        return self._entries
+
+    def __getitem__(self, abbreviation):
+        if self._entries is not None:
+            return self.entries()[abbreviation]
+        entry = self.store.lookup_many(self.site, [abbreviation], default=None)[0]
+        if entry is None:
+            raise KeyError(abbreviation)
+        return entry
+
+    def __contains__(self, abbreviation):
+        if self._entries is not None:
+            return abbreviation in self.entries()
+        return self.store.contains(self.site, abbreviation)
+
+    def __iter__(self):
+        return iter(self.entries())
+
+    def __len__(self):
+        return len(self.entries())
+
+    def items(self):
+        return self.entries().items()
+
+    def values(self):
+        return self.entries().values()
+
+
+class StoreIonTable:
+    "One site of an IonStore, with the lookup methods of ion_reference.IonReferenceTable"
+    def __init__(self, store, site):
+        self.store = store
+        self.site = site
+        self.file_path = store.db_path
+        self.index = StoreIndex(store, site)
+
+    @property
+    def stamp(self):
+        "Changes when the ions of the site are changed"
+        return (self.site, self.store.version(self.site))
+
+    def lookup(self, ion):
+        "All enrichment fields for one ion, or NaN for ions not in the table"
+        return self.store.lookup_many(self.site, [ion])[0]
+
+    def lookup_many(self, ions):
+        "Enrichment fields for a list of ions, with one query"
+        return self.store.lookup_many(self.site, ions)
+
+    def abbreviations(self):
+        return self.store.abbreviations(self.site)
+
+
+class IonStore:
+    "Ion reference tables in a SQLite database"
+    def __init__(self, db_path):
+        self.db_path = os.path.abspath(db_path)
+        self._lock = threading.RLock()
+        self._connection = None
+        self._pid = None
+        self._tables = {}
+        self._sites_by_name = {}
+        # The version of every site, read again when the database has been changed
+        self._versions = None
+        self._data_version = None
+        with self._lock:
+            self.connection().executescript(schema)
+
+    def connection(self):
+        "The connection of this process. Processes forked from this one open their own"
+        if self._connection is None or self._pid != os.getpid():
+            self._connection = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._pid = os.getpid()
+            self._versions = None
+        return self._connection
+
+    def query(self, sql, parameters=()):
+        with self._lock:
+            return self.connection().execute(sql, parameters).fetchall()
+
+    def import_xlsx(self, file_path, site=None):
+        "Replace the ions of a site with the content of an ion table file. Returns the number of ions"
+        if site is None:
+            site = site_from_file_name(file_path)
+        table = read_ion_table(file_path)
+        rows = [(site, abbreviation, position, *entry)
+                for position, (abbreviation, entry) in enumerate(table.index.items())]
+        with self._lock:
+            connection = self.connection()
+            with connection:
+                connection.execute("DELETE FROM ions WHERE site = ?", (site,))
+                connection.executemany(f"INSERT INTO ions (site, Abbreviation, position, {field_list}) "
+                                       f"VALUES ({', '.join('?' * (len(enrichment_columns) + 3))})", rows)
+                connection.execute("INSERT INTO sites (site, file_name) VALUES (?, ?) "
+                                   "ON CONFLICT (site) DO UPDATE SET file_name = excluded.file_name",
+                                   (site, os.path.basename(str(file_path))))
+                self._sites_by_name.clear()
+                self._bump_version(connection, site)
+        return len(rows)
+
+    def _bump_version(self, connection, site):
+        connection.execute("INSERT INTO sites (site) VALUES (?) ON CONFLICT (site) DO NOTHING", (site,))
+        connection.execute("UPDATE sites SET version = version + 1 WHERE site = ?", (site,))
+        # data_version does not change for the changes of this connection
+        self._versions = None
+
+    def sites(self):
+        return [site for site, in self.query("SELECT site FROM sites ORDER BY site")]
+
+    def version(self, site):
+        """Changes every time the ions of the site are changed, also by other processes. The versions
+        are only read again when SQLite reports that the database has been changed"""
+        with self._lock:
+            connection = self.connection()
+            data_version = connection.execute("PRAGMA data_version").fetchone()[0]
+            if self._versions is None or self._data_version != data_version:
+                self._versions = dict(connection.execute("SELECT site, version FROM sites").fetchall())
+                self._data_version = data_version
+            return self._versions.get(site)
+
+    def table(self, site):
+        "The ions of a site as a table for ion_reference, or None if the site is not in the store"
+        table = self._tables.get(site)
+        if table is None:
+            if self.version(site) is None:
+                return None
+            table = self._tables[site] = StoreIonTable(self, site)
+        return table
+
+    def table_for(self, file_path):
+        "The table imported from a file with the same name, used by the ion_reference registry"
+        name = os.path.basename(str(file_path))
+        site = self._sites_by_name.get(name)
+        if site is None:
+            rows = self.query("SELECT site FROM sites WHERE file_name = ?", (name,))
+            if not rows:
+                return None
+            site = self._sites_by_name[name] = rows[0][0]
+        return self.table(site)
+
+    def lookup_many(self, site, ions, default=missing_entry):
+        "Enrichment fields for a list of ions, or the default for ions that are not in the store"
+        found = {}
+        unique = list(dict.fromkeys(ions))
+        for start in range(0, len(unique), max_query_ions):
+            chunk = unique[start:start+max_query_ions]
+            rows = self.query(f"SELECT Abbreviation, {field_list} FROM ions "
+                              f"WHERE site = ? AND Abbreviation IN ({', '.join('?' * len(chunk))})",
+                              (site, *chunk))
+            for abbreviation, *entry in rows:
+                found[abbreviation] = tuple(entry)
+        return [found.get(ion, default) for ion in ions]
+
+    def contains(self, site, abbreviation):
+        return bool(self.query("SELECT 1 FROM ions WHERE site = ? AND Abbreviation = ?", (site, abbreviation)))
+
+    def abbreviations(self, site):
+        "All abbreviations of a site, in table order"
+        return [abbreviation for abbreviation, in
+                self.query("SELECT Abbreviation FROM ions WHERE site = ? ORDER BY position", (site,))]
+
+    def entries(self, site):
+        "(abbreviation, enrichment fields) for all ions of a site, in table order"
+        return [(abbreviation, tuple(entry)) for abbreviation, *entry in
+                self.query(f"SELECT Abbreviation, {field_list} FROM ions WHERE site = ? ORDER BY position", (site,))]
+
+    def count(self, site):
+        return self.query("SELECT COUNT(*) FROM ions WHERE site = ?", (site,))[0][0]
+
+    def find_smiles(self, smiles, site=None):
+        "(site, abbreviation) of the ions with a SMILES"
+        return self._find("SMILE", smiles, site)
+
+    def find_cas(self, cas, site=None):
+        "(site, abbreviation) of the ions with a CAS number"
+        return self._find("CAS", cas, site)
+
+    def _find(self, column, value, site):
+        if site is None:
+            rows = self.query(f"SELECT site, Abbreviation FROM ions WHERE {column} = ? "
+                              "ORDER BY site, position", (value,))
+        else:
+            rows = self.query(f"SELECT site, Abbreviation FROM ions WHERE {column} = ? AND site = ? "
+                              "ORDER BY position", (value, site))
+        return [tuple(row) for row in rows]
+
+    def set_ion(self, site, abbreviation, **fields):
+        """Add an ion, or change fields of an existing one, e.g. set_ion("A", "MA", CAS="...").
+        Fields not given are NaN for new ions"""
+        unknown = set(fields) - set(enrichment_columns)
+        if unknown:
+            raise ValueError(f"Unknown ion fields: {sorted(unknown)}. Use {enrichment_columns}")
+        with self._lock:
+            connection = self.connection()
+            with connection:
+                if self.contains(site, abbreviation):
+                    if fields:
+                        assignments = ", ".join(f"{column} = ?" for column in fields)
+                        connection.execute(f"UPDATE ions SET {assignments} WHERE site = ? AND Abbreviation = ?",
+                                           (*[str(value) for value in fields.values()], site, abbreviation))
+                else:
+                    entry = [str(fields.get(column, "nan")) for column in enrichment_columns]
+                    connection.execute(f"INSERT INTO ions (site, Abbreviation, position, {field_list}) "
+                                       f"SELECT ?, ?, COALESCE(MAX(position) + 1, 0), "
+                                       f"{', '.join('?' * len(enrichment_columns))} FROM ions WHERE site = ?",
+                                       (site, abbreviation, *entry, site))
+                self._bump_version(connection, site)
+
+    def remove_ion(self, site, abbreviation):
+        with self._lock:
+            connection = self.connection()
+            with connection:
+                connection.execute("DELETE FROM ions WHERE site = ? AND Abbreviation = ?", (site, abbreviation))
+                self._bump_version(connection, site)
+
+    def close(self):
+        with self._lock:
+            if self._connection is not None and self._pid == os.getpid():
+                self._connection.close()
+            self._connection = None
+
+
+def use_ion_store(db_path):
+    "Use an IonStore for the tables it has, instead of the xlsx files. Returns the store"
+    store = IonStore(db_path)
+    ion_registry.use_store(store)
+    return store
+
+
+# Import the ion tables in Data_ions
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Import ion reference tables into a SQLite ion store")
+    parser.add_argument("database", help="SQLite file, created if it does not exist")
+    parser.add_argument("files", nargs="*", help="Ion table files. Default: the xlsx files in Data_ions")
+    args = parser.parse_args(argv)
+
+    file_paths = args.files
+    if not file_paths:
+        folder = os.path.join(os.getcwd(), "Data_ions")
+        file_paths = [os.path.join(folder, name) for name in
+                      ("A-ion_data.xlsx", "B-ion_data.xlsx", "C-ion_data.xlsx")]
+    store = IonStore(args.database)
+    for file_path in file_paths:
+        n = store.import_xlsx(file_path)
+        print(f"{site_from_file_name(file_path)}: {n} ions from {file_path}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
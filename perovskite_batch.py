@@ -0,0 +1,344 @@
+"""
+Functionality for converting many perovskite compositions in one pass
+
+The input is a table (pandas DataFrame) with one composition per row and the
+columns A_ions, A_coef, B_ions, B_coef, C_ions, C_coef, Eg, Dimensionality and
+Additives. Ions, coefficients and additives are given either as lists or as
+strings separated by ";", e.g. "Cs; FA; MA".
+
+The records returned have the same fields, in the same order, as
+PerovskiteToJson.convert_to_json.
+
+Large tables can be converted on several cores with convert_parallel. The ion
+reference tables are loaded once in the main process and inherited by the
+worker processes, which each convert chunks of rows.
+
+The stoichiometry of a whole table can be checked with validate_compositions,
+or during conversion by passing a StoichiometryValidator to convert_many.
+"""
+
+import itertools
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from instrumentation import stats, timed
+from ion_reference import get_ion_table, ion_registry
+from ion_store import use_ion_store
+from perovskite_to_json_v2 import (clean_ion, coefficient_string, enclose_ion, ion_data_and_unknown,
+                                   path_a_ions, path_b_ions, path_c_ions)
+from record_writers import JsonFileWriter, JsonLinesWriter
+from stoichiometry import StoichiometryValidator
+
+sites = ("A", "B", "C")
+
+
+def builtin_value(x):
+    "NumPy scalars as the Python int, float, ... they hold, so records only contain built-in types"
+    return x.item() if isinstance(x, np.generic) else x
+
+
+def split_cell(cell):
+    "A list from a table cell given as a list or a string separated by ;"
+    if isinstance(cell, str):
+        return [x.strip() for x in cell.split(";") if x.strip() != ""]
+    if isinstance(cell, (np.ndarray, pd.Series)):
+        return cell.tolist()
+    if isinstance(cell, (list, tuple)):
+        return [builtin_value(x) for x in cell]
+    # Empty cells
+    if cell is None or pd.isna(cell):
+        return []
+    return [builtin_value(cell)]
+
+
+def parse_coefficient(x):
+    "Coefficients given as strings are converted to numbers"
+    if not isinstance(x, str):
+        return x
+    x = x.strip().replace(",", ".")
+    try:
+        return int(x)
+    except ValueError:
+        pass
+    try:
+        return float(x)
+    except ValueError:
+        return x
+
+
+def read_compositions(file_path):
+    "Read a table of compositions from a .csv, .xlsx or .jsonl file"
+    name = str(file_path).lower()
+    if name.endswith(".csv"):
+        return pd.read_csv(file_path)
+    if name.endswith((".xlsx", ".xls")):
+        return pd.read_excel(file_path)
+    if name.endswith((".jsonl", ".jsonl.gz")):
+        return pd.read_json(file_path, lines=True, precise_float=True)
+    raise ValueError(f"Unknown file format for compositions: {file_path}")
+
+
+def get_column(frame, column, default):
+    "A column of the table as a list, or the default value for every row"
+    if column in frame.columns:
+        return [builtin_value(x) for x in frame[column].tolist()]
+    return [default] * len(frame)
+
+
+class SiteFamily:
+    "The sorted ions of one site and their enrichment, shared by every row with the same ions"
+    def __init__(self, ions, table):
+        # Same order as PerovskiteToJson.sort_ions
+        self.order = np.argsort(list(ions))
+        self.ions = [ions[i] for i in self.order]
+        self.enclosed = [enclose_ion(ion) for ion in self.ions]
+        self.short_formula = "".join(self.enclosed)
+        self.data, self.unknown_ions = ion_data_and_unknown(table, self.ions)
+        self.duplicates = len(set(self.ions)) < len(self.ions)
+
+    def sort_coefficients(self, coef):
+        "Order the coefficients like the ions. Missing coefficients are NaN"
+        if len(coef) < len(self.order):
+            coef = coef + list(np.ones(len(self.order)-len(coef))*np.nan)
+        return [coef[i] for i in self.order]
+
+    def long_formula(self, coef):
+        return "".join([ion + coefficient_string(x) for ion, x in zip(self.enclosed, coef)])
+
+
+def factorize_site(ion_column, table):
+    "Group the rows by their (cleaned) ions. Returns a family code per row and the families"
+    codes = []
+    keys = {}
+    for cell in ion_column:
+        key = tuple(clean_ion(ion) for ion in split_cell(cell))
+        code = keys.get(key)
+        if code is None:
+            code = keys[key] = len(keys)
+        codes.append(code)
+    families = [SiteFamily(key, table) for key in keys]
+    return codes, families
+
+
+def build_record(short_formula, long_formula, Eg, Dimensionality, site_data, Additives):
+    "Combine data into a dictionary with the fields of PerovskiteToJson.convert_to_json"
+    record = {
+        "Perovskite family": short_formula,
+        "Perovskite composition": long_formula,
+        "Band gap": Eg,
+        "Dimensionality": Dimensionality,
+    }
+    for site, (ions, coef, data) in zip(sites, site_data):
+        record[site + "_ions"] = list(ions)
+        record[site + "_coef"] = coef
+        set_enrichment_fields(record, site, data)
+    record["Additives"] = Additives
+    return record
+
+
+# Record fields, without the site prefix, filled from the ion reference tables and the 
+# ion_data_dict keys they come from. The IUPAC names are the common names, as in convert_to_json
+enrichment_fields = (
+    ("SMILES", "SMILES"),
+    ("molecular_formula", "molecular_formulas"),
+    ("IUPAC_names", "common_names"),
+    ("common_names", "common_names"),
+    ("cas_numbers", "cas_numbers"),
+    ("parent_SMILES", "Parent_SMILEs"),
+    ("parent_IUPAC_names", "Parent_IUPACs"),
+    ("parent_cas_numbers", "Parent_CAS"),
+)
+
+
+def set_enrichment_fields(record, site, data):
+    "Set the enrichment fields of one site of a record from an ion_data_dict"
+    for field, key in enrichment_fields:
+        record[f"{site}_{field}"] = list(data[key])
+
+
+def factorize_frame(frame, tables):
+    "The family codes, families and parsed coefficients of every site of a table"
+    site_codes = []
+    site_families = []
+    site_coefs = []
+    for site, table in zip(sites, tables):
+        codes, families = factorize_site(get_column(frame, site + "_ions", []), table)
+        site_codes.append(codes)
+        site_families.append(families)
+        site_coefs.append([[parse_coefficient(x) for x in split_cell(cell)]
+                           for cell in get_column(frame, site + "_coef", [])])
+    return site_codes, site_families, site_coefs
+
+
+def check_stoichiometry(validator, site_codes, site_families, site_coefs):
+    "Run a StoichiometryValidator on a factorized table. Per row values are looked up per family"
+    ion_counts = []
+    duplicates = []
+    for codes, families in zip(site_codes, site_families):
+        codes = np.asarray(codes, dtype=np.intp)
+        ion_counts.append(np.array([len(family.ions) for family in families], dtype=np.intp)[codes]
+                          if families else np.zeros(len(codes), dtype=np.intp))
+        duplicates.append(np.array([family.duplicates for family in families], dtype=bool)[codes]
+                          if families else np.zeros(len(codes), dtype=bool))
+    return validator.check(site_coefs, ion_counts, duplicates)
+
+
+def validate_compositions(frame, validator=None, ion_files=(path_a_ions, path_b_ions, path_c_ions)):
+    "Check the stoichiometry of every composition in a table. Returns a ValidationResult"
+    if validator is None:
+        validator = StoichiometryValidator()
+    tables = [get_ion_table(file_path) for file_path in ion_files]
+    return check_stoichiometry(validator, *factorize_frame(frame, tables))
+
+
+@timed("convert_many")
+def convert_many(frame, ion_files=(path_a_ions, path_b_ions, path_c_ions), validator=None):
+    """Convert a table of compositions to a list of perovskite records (dictionaries).
+    With a StoichiometryValidator, coefficients are normalized and compositions with errors
+    left out if the validator is set up to do so"""
+    tables = [get_ion_table(file_path) for file_path in ion_files]
+
+    # Sort, format and enrich every distinct set of ions once per site
+    site_codes, site_families, site_coefs = factorize_frame(frame, tables)
+
+    rows = range(len(frame))
+    if validator is not None:
+        result = check_stoichiometry(validator, site_codes, site_families, site_coefs)
+        for s, coefs in enumerate(site_coefs):
+            for row in np.flatnonzero(result.normalized[:, s]):
+                coefs[row] = result.row_coefficients(s, row)
+        if validator.drop_invalid:
+            rows = np.flatnonzero(result.valid).tolist()
+
+    Eg_column = get_column(frame, "Eg", np.nan)
+    dimensionality_column = get_column(frame, "Dimensionality", "")
+    additives_column = [split_cell(cell) for cell in get_column(frame, "Additives", [])]
+
+    # Combine per row. Only the coefficients differ between rows with the same ions
+    records = []
+    for row in rows:
+        site_data = []
+        short_formula = ""
+        long_formula = ""
+        for codes, families, coefs in zip(site_codes, site_families, site_coefs):
+            family = families[codes[row]]
+            coef = family.sort_coefficients(coefs[row])
+            short_formula += family.short_formula
+            long_formula += family.long_formula(coef)
+            site_data.append((family.ions, coef, family.data))
+            if stats.enabled:
+                stats.count("unknown_ions", family.unknown_ions)
+        records.append(build_record(short_formula, long_formula, Eg_column[row],
+                                    dimensionality_column[row], site_data, additives_column[row]))
+    return records
+
+
+def iter_convert(frame, chunk_size=10000, ion_files=(path_a_ions, path_b_ions, path_c_ions), validator=None):
+    "Generator over the records of a table, converted chunk by chunk"
+    for start in range(0, len(frame), chunk_size):
+        yield from convert_many(frame.iloc[start:start+chunk_size], ion_files=ion_files, validator=validator)
+
+
+# The tables being converted by iter_convert_parallel, by conversion, seen by the worker processes.
+# Several conversions can run at the same time, so every one has its own number
+_worker_frames = {}
+_conversion_numbers = itertools.count()
+
+
+def _init_worker(conversion, frame, ion_files, store_path):
+    "Set up a worker process that is not forked from the main process"
+    _worker_frames[conversion] = frame
+    if store_path is not None:
+        use_ion_store(store_path)
+    for file_path in ion_files:
+        get_ion_table(file_path)
+
+
+def _convert_chunk(bounds, conversion, ion_files, validator=None):
+    start, stop = bounds
+    return convert_many(_worker_frames[conversion].iloc[start:stop], ion_files=ion_files, validator=validator)
+
+
+def iter_convert_parallel(frame, workers=None, chunk_size=5000, 
+                          ion_files=(path_a_ions, path_b_ions, path_c_ions), validator=None):
+    "Generator over the records of a table, converted in chunks by a pool of processes. The row order is kept"
+    # Load the ion tables once, before the workers are started
+    for file_path in ion_files:
+        get_ion_table(file_path)
+    
+    if workers is None:
+        workers = os.cpu_count() or 1
+    if workers <= 1 or len(frame) <= chunk_size:
+        yield from iter_convert(frame, chunk_size=chunk_size, ion_files=ion_files, validator=validator)
+        return
+    
+    bounds = [(start, min(start+chunk_size, len(frame))) for start in range(0, len(frame), chunk_size)]
+    
+    # Forked workers share the table, the ion store and the loaded ion tables with the main process
+    conversion = next(_conversion_numbers)
+    if "fork" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("fork")
+        _worker_frames[conversion] = frame
+        initializer, initargs = None, ()
+    else:
+        context = multiprocessing.get_context("spawn")
+        store = ion_registry.store
+        initializer, initargs = _init_worker, (conversion, frame, ion_files, getattr(store, "db_path", None))
+    
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, 
+                                 initializer=initializer, initargs=initargs) as executor:
+            convert_chunk = partial(_convert_chunk, conversion=conversion, ion_files=ion_files, validator=validator)
+            for records in executor.map(convert_chunk, bounds):
+                yield from records
+    finally:
+        _worker_frames.pop(conversion, None)
+
+
+def convert_parallel(frame, workers=None, chunk_size=5000, ion_files=(path_a_ions, path_b_ions, path_c_ions),
+                     validator=None):
+    "Convert a table of compositions to a list of perovskite records using several processes"
+    return list(iter_convert_parallel(frame, workers=workers, chunk_size=chunk_size, ion_files=ion_files,
+                                      validator=validator))
+
+
+def convert_file_to_folder(input_path, folder_path, one_file_per_composition=False, chunk_size=500, 
+                           cancel_event=None, progress=None, 
+                           ion_files=(path_a_ions, path_b_ions, path_c_ions)):
+    """Convert a file of compositions and save the records in a folder, either in one .jsonl file
+    or as one .json file per composition. progress(done, total) is called after every chunk and the 
+    conversion stops early if cancel_event is set. Returns the number of records saved"""
+    frame = read_compositions(input_path)
+    total = len(frame)
+    name = os.path.splitext(os.path.basename(input_path))[0]
+    done = 0
+    if progress is not None:
+        progress(done, total)
+
+    if one_file_per_composition:
+        writer = JsonFileWriter()
+    else:
+        writer = JsonLinesWriter(os.path.join(folder_path, name + ".jsonl"), append=False)
+    try:
+        for start in range(0, total, chunk_size):
+            if cancel_event is not None and cancel_event.is_set():
+                break
+            for record in convert_many(frame.iloc[start:start+chunk_size], ion_files=ion_files):
+                if one_file_per_composition:
+                    # Same format as PerovskiteToJson.save_data
+                    writer.write(record, os.path.join(folder_path, f"{name}_{done}.json"))
+                else:
+                    writer.write(record)
+                done += 1
+            if progress is not None:
+                progress(done, total)
+    finally:
+        writer.close()
+    if one_file_per_composition and writer.errors:
+        raise writer.errors[0]
+    return done
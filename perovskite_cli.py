@@ -0,0 +1,192 @@
+"""
+Command line tool for converting a file of perovskite compositions to Json
+
+The input is a .csv, .xlsx or .jsonl file with one composition per row (see
+perovskite_batch for the columns). The output is a .jsonl file (one compact
+record per line, .jsonl.gz for gzip) or a .json file with a list of records
+(.json.gz for gzip).
+
+Example:
+    python perovskite_cli.py compositions.csv perovskites.jsonl --workers 8
+"""
+
+import argparse
+import gzip
+import json
+import sys
+import time
+
+from instrumentation import stats
+from ion_reference import get_ion_table, missing_entry
+from ion_store import use_ion_store
+from perovskite_batch import iter_convert_parallel, read_compositions, sites, validate_compositions
+from perovskite_to_json_v2 import path_a_ions, path_b_ions, path_c_ions
+from record_writers import JsonLinesWriter
+from serializers import backends, get_serializer
+from stoichiometry import StoichiometryValidator
+
+
+class JsonListWriter:
+    """Write records as one Json list, in the same indented format as PerovskiteToJson. Gzip
+    compressed if the file name ends with .gz"""
+    def __init__(self, file_path, backend="json"):
+        self.serializer = get_serializer(backend, pretty=True)
+        if str(file_path).endswith(".gz"):
+            self._file = gzip.open(file_path, "wt", encoding="utf-8")
+        else:
+            self._file = open(file_path, "w", encoding="utf-8")
+        self._file.write("[")
+        self.count = 0
+
+    def write(self, record):
+        if self.count > 0:
+            self._file.write(",")
+        self._file.write("\n" + self.serializer.dumps(record))
+        self.count += 1
+
+    def close(self):
+        self._file.write("\n]\n")
+        self._file.close()
+
+
+def open_writer(file_path, buffer_size, backend="json"):
+    "A writer chosen from the file ending of the output"
+    if str(file_path).lower().endswith((".json", ".json.gz")):
+        return JsonListWriter(file_path, backend=backend)
+    return JsonLinesWriter(file_path, buffer_size=buffer_size, append=False, backend=backend)
+
+
+def count_unknown_ions(record, tables, unknown, known=None):
+    """Count the ions in a record that are not in the ion tables (the NaN fallbacks). known caches
+    whether an ion is in the table, per site, so each ion is only looked up once"""
+    if known is None:
+        known = [{} for _ in tables]
+    for site, table, site_known in zip(sites, tables, known):
+        ions = record[site + "_ions"]
+        new_ions = [ion for ion in dict.fromkeys(ions) if ion not in site_known]
+        if new_ions:
+            for ion, entry in zip(new_ions, table.lookup_many(new_ions)):
+                site_known[ion] = entry is not missing_entry
+        for ion in ions:
+            if not site_known[ion]:
+                unknown[ion] = unknown.get(ion, 0) + 1
+
+
+def convert_file(input_path, output_path, workers=1, chunk_size=5000, buffer_size=1000, 
+                 backend="json", ion_files=(path_a_ions, path_b_ions, path_c_ions), validator=None):
+    """Convert a file of compositions and return a report with timings and unknown ions,
+    and the number of compositions with each stoichiometry error if a validator is given"""
+    timings = {}
+    start = time.perf_counter()
+    tables = [get_ion_table(file_path) for file_path in ion_files]
+    timings["load_ion_tables"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    frame = read_compositions(input_path)
+    timings["read"] = time.perf_counter() - start
+
+    stoichiometry_errors = None
+    if validator is not None:
+        start = time.perf_counter()
+        result = validate_compositions(frame, validator, ion_files=ion_files)
+        stoichiometry_errors = result.counts()
+        stoichiometry_errors["invalid_compositions"] = int((~result.valid).sum())
+        timings["validate"] = time.perf_counter() - start
+
+    # Conversion and writing are interleaved, so time them separately
+    timings["convert"] = 0.0
+    timings["write"] = 0.0
+    unknown = {}
+    known = [{} for _ in tables]
+    writer = open_writer(output_path, buffer_size, backend=backend)
+    records = iter_convert_parallel(frame, workers=workers, chunk_size=chunk_size, ion_files=ion_files,
+                                    validator=validator)
+    try:
+        while True:
+            start = time.perf_counter()
+            record = next(records, None)
+            timings["convert"] += time.perf_counter() - start
+            if record is None:
+                break
+            count_unknown_ions(record, tables, unknown, known)
+            start = time.perf_counter()
+            writer.write(record)
+            timings["write"] += time.perf_counter() - start
+    finally:
+        start = time.perf_counter()
+        writer.close()
+        timings["write"] += time.perf_counter() - start
+
+    total = sum(timings.values())
+    report = {
+        "records": writer.count,
+        "seconds": total,
+        "records_per_second": writer.count / total if total > 0 else float("nan"),
+        "timings": timings,
+        "unknown_ions": sum(unknown.values()),
+        "unknown_ion_names": dict(sorted(unknown.items(), key=lambda item: -item[1])),
+    }
+    if stoichiometry_errors is not None:
+        report["stoichiometry_errors"] = stoichiometry_errors
+    return report
+
+
+def print_report(report, outfile=sys.stderr):
+    print(f"Converted {report['records']} records in {report['seconds']:.2f} s "
+          f"({report['records_per_second']:.0f} records/s)", file=outfile)
+    for stage, seconds in report["timings"].items():
+        print(f"  {stage:<16} {seconds:8.3f} s", file=outfile)
+    print(f"Unknown ions: {report['unknown_ions']}", file=outfile)
+    for ion, n in list(report["unknown_ion_names"].items())[:20]:
+        print(f"  {ion:<16} {n}", file=outfile)
+    if "stoichiometry_errors" in report:
+        errors = report["stoichiometry_errors"]
+        print(f"Compositions with stoichiometry errors: {errors['invalid_compositions']}", file=outfile)
+        for name, n in errors.items():
+            if name != "invalid_compositions" and n:
+                print(f"  {name:<20} {n}", file=outfile)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert perovskite compositions to Json records")
+    parser.add_argument("input", help="Compositions as .csv, .xlsx or .jsonl")
+    parser.add_argument("output", help="Output file, .jsonl, .jsonl.gz, .json or .json.gz")
+    parser.add_argument("--workers", type=int, default=1, help="Number of worker processes")
+    parser.add_argument("--chunk-size", type=int, default=5000, help="Rows per chunk sent to a worker")
+    parser.add_argument("--buffer-size", type=int, default=1000, help="Records buffered before writing")
+    parser.add_argument("--json-backend", default="json", choices=list(backends) + ["auto"],
+                        help="Json serializer. orjson and ujson must be installed")
+    parser.add_argument("--validate", action="store_true", 
+                        help="Check that the A, B and C coefficients sum to 1, 1 and 3")
+    parser.add_argument("--tolerance", type=float, default=0.05, help="Allowed deviation of a site sum")
+    parser.add_argument("--normalize", action="store_true", 
+                        help="Scale site coefficients that are off by less than the tolerance")
+    parser.add_argument("--decimals", type=int, default=4, help="Decimals of the normalized coefficients")
+    parser.add_argument("--drop-invalid", action="store_true", help="Leave out compositions with errors")
+    parser.add_argument("--ion-store", help="SQLite ion store (see ion_store) to use instead of Data_ions")
+    parser.add_argument("--report", help="Also save the report as Json to this file")
+    parser.add_argument("--stats", help="Save per-stage timings and counters as Json to this file. "
+                        "Only covers work done in this process, so use with --workers 1")
+    args = parser.parse_args(argv)
+    if args.stats:
+        stats.enable()
+    if args.ion_store:
+        use_ion_store(args.ion_store)
+
+    validator = None
+    if args.validate or args.normalize or args.drop_invalid:
+        validator = StoichiometryValidator(tolerance=args.tolerance, normalize=args.normalize, 
+                                           decimals=args.decimals, drop_invalid=args.drop_invalid)
+    report = convert_file(args.input, args.output, workers=args.workers, 
+                          chunk_size=args.chunk_size, buffer_size=args.buffer_size, 
+                          backend=args.json_backend, validator=validator)
+    print_report(report)
+    if args.report:
+        with open(args.report, "w") as outfile:
+            json.dump(report, outfile, indent=4)
+    if args.stats:
+        stats.dump(args.stats)
+
+
+if __name__ == "__main__":
+    main()
@@ -7,12 +7,17 @@ The background is described in the paper ...
 """
 
 import os
+import threading
+from collections import OrderedDict
 from itertools import zip_longest
 
-import pandas as pd
 import numpy as np
 import json
 
+from instrumentation import stats, timed
+from ion_reference import enrichment_columns, get_ion_table, missing_entry
+from serializers import get_serializer
+
 
 # Filepaths
 path_data_ion_folder = os.path.join(os.getcwd(), "Data_ions")
@@ -23,8 +28,129 @@ path_c_ions = os.path.join(path_data_ion_folder, "C-ion_data.xlsx")
 
 path_json_file = os.path.join(path_json_files, "test.json")
 
+# Keys in the dictionary returned by get_ion_complementary_data, in the same order as enrichment_columns
+data_dict_keys = ("common_names", "iupac_names", "SMILES", "molecular_formulas", 
+                  "cas_numbers", "Parent_SMILEs", "Parent_IUPACs", "Parent_CAS")
+
+# Attributes set by PerovskiteToJson.enrich_ions
+enrichment_attributes = {site + attribute for site in "ABC" for attribute in 
+                         ("_common_names", "_iupac_names", "_SMILES", "_molecular_formula", 
+                          "_cas_numbers", "_parent_smiles", "_parent_iupac", "_parent_cas")}
+
+def clean_ion(ion):
+    "Remove trailing blank spaces and any enclosing parenthesis"
+    ion = ion.strip()
+    if (ion[0] == "(" and ion[-1] == ")"):
+        ion = ion[1:-1]
+    return ion
+
+def enclose_ion(ion, n=2):
+    "Enclose an ion with more than n letters with a parenthesis"
+    if len(ion) > n:
+        return "".join(["(", ion, ")"])
+    return ion
+
+def coefficient_string(coef):
+    "A coefficient as it is written in the long formula. Ones are left out"
+    x = str(coef)
+    if x in [' 1', '1', '1 ']:
+        return ''
+    return x
+
+def ion_data_dict(table, ions):
+    "Complementary data for a list of ions from an ion reference table, one lookup per ion"
+    return ion_data_and_unknown(table, ions)[0]
+
+def ion_data_and_unknown(table, ions):
+    "The data dictionary for a list of ions, and how many of them are not in the table"
+    entries = table.lookup_many(ions)
+    columns = [list(column) for column in zip(*entries)] or [[] for _ in enrichment_columns]
+    return dict(zip(data_dict_keys, columns)), sum(entry is missing_entry for entry in entries)
+
+class CompositionFamily:
+    "The sorting, short formula and ion data shared by all compositions with the same ions"
+    def __init__(self, A_ions, B_ions, C_ions):
+        self.orders = [np.argsort(list(ions)) for ions in (A_ions, B_ions, C_ions)]
+        self.ions = [[ions[i] for i in order] for ions, order in zip((A_ions, B_ions, C_ions), self.orders)]
+        self.short_formula = self.build_short_formula()
+        self.unknown_ions = 0
+        self._data = None
+        self._stamps = None
+
+    @timed("get_short_formula")
+    def build_short_formula(self):
+        return "".join([enclose_ion(ion) for ions in self.ions for ion in ions])
+
+    @timed("sort_ions")
+    def sort_site(self, site, coef):
+        "Sorted ions and coefficients for site 0, 1 or 2 (A, B or C)"
+        order = self.orders[site]
+        
+        # Check if coefficients are given for all ions   
+        if len(coef) < len(order):
+            coef.extend(list(np.ones(len(order)-len(coef))*np.nan))
+        
+        return list(self.ions[site]), [coef[i] for i in order]
+
+    def ion_data(self):
+        "Data dictionaries for the A, B and C ions. Refreshed if an ion table has changed"
+        tables = [get_ion_table(file_path) for file_path in (path_a_ions, path_b_ions, path_c_ions)]
+        stamps = [(table.file_path, table.stamp) for table in tables]
+        if self._stamps != stamps:
+            results = [ion_data_and_unknown(table, ions) for table, ions in zip(tables, self.ions)]
+            self._data = [data for data, _ in results]
+            self.unknown_ions = sum(unknown for _, unknown in results)
+            self._stamps = stamps
+        return self._data
+
+class CompositionCache:
+    "Bounded cache of composition families, keyed by the cleaned ions, with least recently used eviction"
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._families = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, A_ions, B_ions, C_ions):
+        "The family for the ions, from the cache if possible"
+        key = (tuple(clean_ion(ion) for ion in A_ions), 
+               tuple(clean_ion(ion) for ion in B_ions), 
+               tuple(clean_ion(ion) for ion in C_ions))
+        with self._lock:
+            family = self._families.get(key)
+            if family is not None:
+                self._families.move_to_end(key)
+                self.hits += 1
+                stats.count("composition_cache_hits")
+                return family
+            self.misses += 1
+            stats.count("composition_cache_misses")
+        
+        family = CompositionFamily(*key)
+        with self._lock:
+            self._families[key] = family
+            while len(self._families) > self.maxsize:
+                self._families.popitem(last=False)
+        return family
+
+    def stats(self):
+        "Hits, misses and size of the cache"
+        with self._lock:
+            return {"hits": self.hits, "misses": self.misses, 
+                    "size": len(self._families), "maxsize": self.maxsize}
+
+    def clear(self):
+        with self._lock:
+            self._families.clear()
+            self.hits = 0
+            self.misses = 0
+
+# The shared cache used by PerovskiteToJson
+composition_cache = CompositionCache()
+
 class PerovskiteToJson:
-    def __init__(self, A_ions=[], A_coef=[], B_ions=[], B_coef=[], C_ions=[], C_coef=[], Eg=np.nan, Dimensionality="", Additives=[], filepath=path_json_file):
+    def __init__(self, A_ions=[], A_coef=[], B_ions=[], B_coef=[], C_ions=[], C_coef=[], Eg=np.nan, Dimensionality="", Additives=[], filepath=path_json_file, lazy=False):
         self.A_ions = A_ions
         self.A_coef = A_coef
         self.B_ions = B_ions
@@ -35,24 +161,70 @@ class PerovskiteToJson:
         self.Dimensionality = Dimensionality
         self.Additives = Additives
         self.path = filepath
+        self.lazy = lazy
+                
+        # Compositions with the same ions share their sorting, short formula and ion data
+        self.composition_family = composition_cache.get(self.A_ions, self.B_ions, self.C_ions)
                 
         # Sort A_ions in alphabetic order
-        self.A_ions, self.A_coef = self.sort_ions(self.A_ions, self.A_coef)
+        self.A_ions, self.A_coef = self.composition_family.sort_site(0, self.A_coef)
         
         # Sort B_ions in alphabetic order
-        self.B_ions, self.B_coef = self.sort_ions(self.B_ions, self.B_coef)
+        self.B_ions, self.B_coef = self.composition_family.sort_site(1, self.B_coef)
         
         # Sort C_ions in alphabetic order
-        self.C_ions, self.C_coef = self.sort_ions(self.C_ions, self.C_coef)
+        self.C_ions, self.C_coef = self.composition_family.sort_site(2, self.C_coef)
+        
+        # In lazy mode, formulas, ion data and the Json string are computed when first used
+        # and nothing is saved until save_data is called
+        if lazy:
+            return
         
         # Get perovskite short composition
-        self.short_formula = self.get_short_formula()
+        self.short_formula = self.composition_family.short_formula
         
         # Get perovskite long composition
         self.long_formula = self.get_long_formula()
         
+        # Get complementary data for all ions
+        self.enrich_ions()
+           
+        # Format the dimensionality
+        
+        # Format the Additives
+        
+        # Convert data to a Json-file
+        self.json = self.convert_to_json()
+        
+        # Save Json file
+        self.save_data(file_path = self.path)
+        
+    def __getattr__(self, name):
+        "Compute formulas, ion data and the Json string on first access (lazy mode)"
+        if name == "short_formula":
+            value = self.composition_family.short_formula
+        elif name == "long_formula":
+            value = self.get_long_formula()
+        elif name == "json":
+            value = self.convert_to_json()
+        elif name in enrichment_attributes:
+            self.enrich_ions()
+            return self.__dict__[name]
+        else:
+            raise AttributeError(f"'{type(self).__name__}' object has no attribute '{name}'")
+        setattr(self, name, value)
+        return value
+
+    @timed("get_ion_complementary_data")
+    def enrich_ions(self):
+        "Get complementary data about the A, B and C ions from the ion reference tables"
+        # Shared by all compositions with the same ions, so every object gets its own copy of the lists
+        data_dicts = [{key: list(values) for key, values in data_dict.items()} 
+                      for data_dict in self.composition_family.ion_data()]
+        stats.count("unknown_ions", self.composition_family.unknown_ions)
+        
         # Get A-ion complementary data
-        data_dict = self.get_ion_complementary_data(self.A_ions, path_a_ions)
+        data_dict = data_dicts[0]
         self.A_common_names = data_dict["common_names"]
         self.A_iupac_names = data_dict["iupac_names"]
         self.A_SMILES = data_dict["SMILES"]
@@ -63,7 +235,7 @@ class PerovskiteToJson:
         self.A_parent_cas = data_dict["Parent_CAS"]
                     
         # Get B-ion complementary data
-        data_dict = self.get_ion_complementary_data(self.B_ions, path_b_ions)
+        data_dict = data_dicts[1]
         self.B_common_names = data_dict["common_names"]
         self.B_iupac_names = data_dict["iupac_names"]
         self.B_SMILES = data_dict["SMILES"]
@@ -74,7 +246,7 @@ class PerovskiteToJson:
         self.B_parent_cas = data_dict["Parent_CAS"]
     
         # Get C-ion complementary data
-        data_dict = self.get_ion_complementary_data(self.C_ions, path_c_ions)
+        data_dict = data_dicts[2]
         self.C_common_names = data_dict["common_names"]
         self.C_iupac_names = data_dict["iupac_names"]
         self.C_SMILES = data_dict["SMILES"]
@@ -83,31 +255,23 @@ class PerovskiteToJson:
         self.C_parent_smiles = data_dict["Parent_SMILEs"] 
         self.C_parent_iupac = data_dict["Parent_IUPACs"]
         self.C_parent_cas = data_dict["Parent_CAS"]
-           
-        # Format the dimensionality
-        
-        # Format the Additives
-        
-        # Convert data to a Json-file
-        self.json = self.convert_to_json()
-        
-        # Save Json file
-        self.save_data(file_path = self.path)
-        
-        
+
 
     def add_paranteses(self, ions, n=2):
         # Enclose every ion with three letters or more with a parenthesis
-        new_list = []
-        for i, ion in enumerate(ions):
-            if len(ion) > n:
-                new_list.append("".join(["(", ion, ")"]))
-            else:
-                new_list.append(ion)
-        return new_list
+        return [enclose_ion(ion, n) for ion in ions]
 
+    @timed("convert_to_json")
     def convert_to_json(self):
         "Convert to Json"
+        return json.dumps(self.to_dict(), indent=4)
+    
+    def to_bytes(self, backend="json", pretty=False):
+        "Convert to Json as bytes, compact by default. The backend is json, orjson, ujson or auto"
+        return get_serializer(backend, pretty).dumpb(self.to_dict())
+    
+    def to_dict(self):
+        "The perovskite data as a dictionary with the same fields as the Json-file"
         
         # Combine data into a dictionary
         perovskite_data ={
@@ -148,43 +312,19 @@ class PerovskiteToJson:
             "Additives": self.Additives,    
         }
         
-        # Convert to json
-        return json.dumps(perovskite_data, indent=4)
+        return perovskite_data
        
     def get_data_from_ion_datatables(self, ion_data, ions, column):
-        names = []
-        for ion in ions:
-            name = ion_data.loc[ion_data["Abbreviation"] == ion, column].values
-            # If not in database
-            if len(name) == 0:
-                names.append("NaN") 
-            # If not unique, chose the first one
-            elif len(name) > 1:
-                names.append(str(name[0]))          
-            else:
-                names.append(str(name[0]))
-                            
-        names = [name.strip() for name in names]
-        return names
+        "Get one column of data for the ions. NaN if not in database"
+        i = enrichment_columns.index(column)
+        return [entry[i] for entry in ion_data.lookup_many(ions)]
         
+    @timed("get_ion_complementary_data")
     def get_ion_complementary_data(self, ions, file_path):
         "Get complementary data about ions from file"
-        ion_data = pd.read_excel(file_path)
-        
-        data_dict = {}
-        
-        # Get data
-        data_dict["common_names"] = self.get_data_from_ion_datatables(ion_data, ions, "Common_name")
-        data_dict["iupac_names"] = self.get_data_from_ion_datatables(ion_data, ions, "IUPAC_name")
-        data_dict["SMILES"] = self.get_data_from_ion_datatables(ion_data, ions, "SMILE")
-        data_dict["molecular_formulas"] = self.get_data_from_ion_datatables(ion_data, ions, "Molecular_formula")
-        data_dict["cas_numbers"]  = self.get_data_from_ion_datatables(ion_data, ions, "CAS")   
-        data_dict["Parent_SMILEs"]  = self.get_data_from_ion_datatables(ion_data, ions, "Parent_SMILE")
-        data_dict["Parent_IUPACs"]  = self.get_data_from_ion_datatables(ion_data, ions, "Parent_IUPAC")
-        data_dict["Parent_CAS"]  = self.get_data_from_ion_datatables(ion_data, ions, "Parent_CAS")
-        
-        return data_dict
+        return ion_data_dict(get_ion_table(file_path), ions)
  
+    @timed("get_long_formula")
     def get_long_formula(self):
         
         "The compleat perovskite formula"
@@ -204,15 +344,10 @@ class PerovskiteToJson:
         b_coef_list = self.B_coef
         c_coef_list = self.C_coef
         
-        # Convert coefficients to strings
-        a_coef_list = [str(x) for x in a_coef_list]
-        b_coef_list = [str(x) for x in b_coef_list]
-        c_coef_list = [str(x) for x in c_coef_list]
-        
-        # Replace ones with empty strings
-        a_coef_list = ['' if x in [' 1', '1', '1 '] else x for x in a_coef_list]
-        b_coef_list = ['' if x in [' 1', '1', '1 '] else x for x in b_coef_list]
-        c_coef_list = ['' if x in [' 1', '1', '1 '] else x for x in c_coef_list]
+        # Convert coefficients to strings and replace ones with empty strings
+        a_coef_list = [coefficient_string(x) for x in a_coef_list]
+        b_coef_list = [coefficient_string(x) for x in b_coef_list]
+        c_coef_list = [coefficient_string(x) for x in c_coef_list]
         
         # Zip together the lists
         a_compleat = list(zip_longest(a_list, a_coef_list, fillvalue = ''))
@@ -232,6 +367,7 @@ class PerovskiteToJson:
 
         return LongComp
            
+    @timed("get_short_formula")
     def get_short_formula(self):
         "The perovskite family"
         # The ions
@@ -252,15 +388,11 @@ class PerovskiteToJson:
 
         return shortComp
 
+    @timed("sort_ions")
     def sort_ions(self, ions, coef):
         "Sort ions in alphabetic order"   
-        # Remove trailing blank spaces
-        ions = [ion.strip() for ion in ions]
-        
-        # Remove any enclosing parenthesizes 
-        for i, ion in enumerate(ions):
-            if (ion[0] == "(" and ion[-1] == ")"):
-                ions[i] = ion[1:-1]   
+        # Remove trailing blank spaces and any enclosing parenthesizes
+        ions = [clean_ion(ion) for ion in ions]
         
         # Check if coefficients are given for all ions   
         if len(coef) < len(ions):
@@ -275,8 +407,13 @@ class PerovskiteToJson:
         
         return ion_list, coef_list
       
-    def save_data(self, file_path):
-        "Save data"
+    @timed("save_data")
+    def save_data(self, file_path, backend=None, pretty=True):
+        "Save data. If a Json backend is given, the data is serialized with it and written as bytes"
+        if backend is not None:
+            with open(file_path, "wb") as outfile:
+                outfile.write(self.to_bytes(backend=backend, pretty=pretty))
+            return
         # with open("test.json", "w") as outfile:
         #     outfile.write(self.json)       
         with open(file_path, "w") as outfile:
@@ -297,7 +434,6 @@ if __name__ == "__main__":
     Eg = 1.63
     Dimensionality = "3D"
     Additives = ["RbI", "PbI2"]
-    filepath=os.getcwd()
     
     perovskite = PerovskiteToJson(A_ions=A_ions, 
                                   A_coef=A_coef, 
@@ -308,7 +444,7 @@ if __name__ == "__main__":
                                   Eg=Eg, 
                                   Dimensionality=Dimensionality, 
                                   Additives=Additives, 
-                                  filepath=filepath)
+                                  lazy=True)
     
     print(perovskite.A_ions)
     print(perovskite.A_coef)
@@ -316,4 +452,5 @@ if __name__ == "__main__":
     print(perovskite.long_formula)
     
     # Save data
+    os.makedirs(path_json_files, exist_ok=True)
     perovskite.save_data(path_json_file)
\ No newline at end of file
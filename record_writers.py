@@ -0,0 +1,221 @@
+"""
+Functionality for writing many perovskite records to file
+
+JsonLinesWriter appends one compact Json record per line to a single .jsonl
+file (gzip compressed if the file name ends with .gz) instead of writing one
+pretty-printed file per composition. The records are serialized with any of
+the backends in serializers (json, orjson, ujson) and written as bytes.
+
+JsonFileWriter is for when one .json file per composition is needed. Files
+are written by a pool of threads, so slow (e.g. network) file systems are
+not waited on one file at a time, and every file is first written to a
+temporary file in the same folder and then renamed into place, so a crash
+never leaves a truncated file behind.
+"""
+
+import gzip
+import itertools
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+from serializers import get_serializer
+
+
+class JsonLinesWriter:
+    "Write perovskite records as Json Lines, keeping at most buffer_size records in memory"
+    def __init__(self, file_path, buffer_size=1000, append=True, compress=None, backend="json"):
+        self.file_path = file_path
+        self.buffer_size = buffer_size
+        self.serializer = get_serializer(backend, pretty=False)
+        self.count = 0
+        self._buffer = []
+
+        if compress is None:
+            compress = str(file_path).endswith(".gz")
+        mode = "ab" if append else "wb"
+        if compress:
+            self._file = gzip.open(file_path, mode)
+        else:
+            self._file = open(file_path, mode)
+
+    def write(self, record):
+        "Add one record (a dictionary or a PerovskiteToJson object)"
+        if hasattr(record, "to_dict"):
+            record = record.to_dict()
+        self._buffer.append(self.serializer.dumpb(record))
+        self.count += 1
+        if len(self._buffer) >= self.buffer_size:
+            self.flush()
+
+    def write_many(self, records):
+        "Add all records from an iterable, e.g. a generator"
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        "Write the buffered records to file"
+        if self._buffer:
+            self._file.write(b"\n".join(self._buffer) + b"\n")
+            self._buffer = []
+        self._file.flush()
+
+    def close(self):
+        if self._file.closed:
+            return
+        self.flush()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+class JsonFileWriter:
+    """Write perovskite records to one Json file each, with at most max_workers files written at
+    the same time and at most max_pending records waiting in memory. Every write returns a
+    Future with the file path, and callback(future) is called when a write is done"""
+    def __init__(self, max_workers=8, max_pending=None, backend="json", pretty=True, 
+                 durable=False, callback=None):
+        self.serializer = get_serializer(backend, pretty=pretty)
+        self.durable = durable
+        self.callback = callback
+        self.count = 0
+        self.errors = []
+        self._lock = threading.Lock()
+        self._pending = threading.BoundedSemaphore(max_pending or 4 * max_workers)
+        self._executor = ThreadPoolExecutor(max_workers)
+
+    def write(self, record, file_path):
+        "Queue a record (a dictionary or a PerovskiteToJson object) to be saved to file_path"
+        if hasattr(record, "to_dict"):
+            record = record.to_dict()
+        # Blocks while max_pending records are waiting to be written
+        self._pending.acquire()
+        try:
+            future = self._executor.submit(self._save, record, file_path)
+        except BaseException:
+            self._pending.release()
+            raise
+        future.add_done_callback(self._done)
+        return future
+
+    def write_many(self, records_and_paths):
+        "Queue (record, file_path) pairs from any iterable, e.g. a generator"
+        for record, file_path in records_and_paths:
+            self.write(record, file_path)
+
+    def _save(self, record, file_path):
+        data = self.serializer.dumpb(record)
+        with replacing_file(file_path, durable=self.durable) as outfile:
+            outfile.write(data)
+        return file_path
+
+    def _done(self, future):
+        self._pending.release()
+        with self._lock:
+            if future.exception() is None:
+                self.count += 1
+            else:
+                self.errors.append(future.exception())
+        if self.callback is not None:
+            self.callback(future)
+
+    def close(self):
+        "Wait until every queued record is written"
+        self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+temp_numbers = itertools.count()
+open_flags = os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0)
+
+
+def open_temporary_file(folder_path):
+    """Create a new temporary file in a folder. Returns the file descriptor and path. The file
+    gets the permissions of a file made with open, 0o666 without the umask of the process"""
+    while True:
+        temp_path = os.path.join(folder_path, f".{os.getpid()}.{next(temp_numbers)}.tmp")
+        try:
+            return os.open(temp_path, open_flags, 0o666), temp_path
+        except FileExistsError:
+            # Left behind by an earlier process with the same id
+            continue
+
+
+@contextmanager
+def replacing_file(file_path, durable=False):
+    """A new binary file, written next to file_path and renamed to it at the end of the with
+    block, so file_path is never left half written. Removed if the block raises. Safe to use
+    from many threads, also for the same file_path. With durable=True, the data is on disk
+    before the rename"""
+    handle, temp_path = open_temporary_file(os.path.dirname(os.path.abspath(file_path)))
+    try:
+        with os.fdopen(handle, "wb") as outfile:
+            yield outfile
+            if durable:
+                outfile.flush()
+                os.fsync(outfile.fileno())
+        os.replace(temp_path, file_path)
+    except BaseException:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+def write_json_files(records_and_paths, max_workers=8, backend="json", pretty=True, durable=False):
+    """Save (record, file_path) pairs from any iterable, one Json file per record.
+    Returns the number of files written, and raises the first error if any write failed"""
+    with JsonFileWriter(max_workers=max_workers, backend=backend, pretty=pretty, durable=durable) as writer:
+        writer.write_many(records_and_paths)
+    if writer.errors:
+        raise writer.errors[0]
+    return writer.count
+
+
+def stream_to_json_lines(records, writer):
+    "Generator that writes every record as it passes through and yields it on"
+    for record in records:
+        writer.write(record)
+        yield record
+
+
+def write_json_lines(records, file_path, buffer_size=1000, append=True, compress=None, backend="json"):
+    "Write records from any iterable to a Json Lines file. Returns the number of records written"
+    with JsonLinesWriter(file_path, buffer_size=buffer_size, append=append, 
+                         compress=compress, backend=backend) as writer:
+        writer.write_many(records)
+    return writer.count
+
+
+def open_lines(file_path, mode="rb"):
+    "Open a Json Lines file in a binary mode, gzip compressed if the name ends with .gz"
+    if str(file_path).endswith(".gz"):
+        return gzip.open(file_path, mode)
+    return open(file_path, mode)
+
+
+def iter_json_lines(infile):
+    """Generator over the (record number, line) of the records in an open Json Lines file.
+    Empty lines are skipped, and not counted in the record numbers, as in IndexedJsonLines"""
+    record_number = 0
+    for line in infile:
+        if line.strip():
+            yield record_number, line
+            record_number += 1
+
+
+def read_json_lines(file_path):
+    "Generator over the records in a Json Lines file (gzip if the name ends with .gz)"
+    with open_lines(file_path, "rb") as infile:
+        for _, line in iter_json_lines(infile):
+            yield json.loads(line)
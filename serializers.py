@@ -0,0 +1,100 @@
+"""
+Functionality for serializing perovskite records to Json with different backends
+
+Backends:
+    "json"    The standard library. Same output as PerovskiteToJson.convert_to_json
+    "orjson"  Much faster, if orjson is installed
+    "ujson"   Faster, if ujson is installed
+    "auto"    The fastest installed backend
+
+All backends keep the fields and their order. Differences to the standard library:
+orjson writes NaN (e.g. a missing band gap or coefficient) as null and pretty
+prints with an indent of two spaces, and ujson may format floats differently.
+"""
+
+import json
+
+import numpy as np
+
+backends = ("json", "orjson", "ujson")
+
+
+def to_builtin(obj):
+    "Convert numpy scalars and arrays, which orjson and ujson do not know about"
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    raise TypeError(f"Type is not Json serializable: {type(obj).__name__}")
+
+
+class JsonSerializer:
+    "Json serialization with one backend, as text or as bytes, compact or pretty"
+    def __init__(self, backend="json", pretty=False):
+        self.backend = backend
+        self.pretty = pretty
+
+    def dumps(self, obj):
+        "Serialize to a string"
+        return json.dumps(obj, indent=4 if self.pretty else None,
+                          separators=None if self.pretty else (",", ":"), default=to_builtin)
+
+    def dumpb(self, obj):
+        "Serialize to utf-8 encoded bytes, e.g. for writing to a binary file"
+        return self.dumps(obj).encode("utf-8")
+
+
+class OrjsonSerializer(JsonSerializer):
+    def __init__(self, backend="orjson", pretty=False):
+        super().__init__(backend, pretty)
+        import orjson
+        self._orjson = orjson
+        self._option = orjson.OPT_INDENT_2 if pretty else 0
+
+    def dumps(self, obj):
+        return self.dumpb(obj).decode("utf-8")
+
+    def dumpb(self, obj):
+        return self._orjson.dumps(obj, default=to_builtin, option=self._option)
+
+
+class UjsonSerializer(JsonSerializer):
+    def __init__(self, backend="ujson", pretty=False):
+        super().__init__(backend, pretty)
+        import ujson
+        self._ujson = ujson
+
+    def dumps(self, obj):
+        return self._ujson.dumps(obj, indent=4 if self.pretty else 0,
+                                 ensure_ascii=False, default=to_builtin)
+
+
+serializer_classes = {
+    "json": JsonSerializer,
+    "orjson": OrjsonSerializer,
+    "ujson": UjsonSerializer,
+}
+
+
+def available_backends():
+    "The backends that can be used in this environment"
+    available = ["json"]
+    for backend in ("orjson", "ujson"):
+        try:
+            __import__(backend)
+        except ImportError:
+            continue
+        available.append(backend)
+    return available
+
+
+def get_serializer(backend="json", pretty=False):
+    "A serializer for a backend. Raises ImportError if the backend is not installed"
+    if backend is None:
+        backend = "json"
+    if backend == "auto":
+        available = available_backends()
+        backend = next(b for b in ("orjson", "ujson", "json") if b in available)
+    if backend not in serializer_classes:
+        raise ValueError(f"Unknown Json backend: {backend}. Use one of {backends} or auto")
+    return serializer_classes[backend](backend, pretty)
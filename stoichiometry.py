@@ -0,0 +1,150 @@
+"""
+Functionality for checking the stoichiometry of many perovskite compositions at once
+
+The coefficients of every site are put in a NumPy array with one row per
+composition, and all rows are checked together. Every row gets an error code,
+where each bit is one problem:
+
+    missing_coefficient   Fewer coefficients than ions on a site
+    extra_coefficient     More coefficients than ions on a site
+    invalid_coefficient   A coefficient that is not a number, or is negative
+    duplicate_ion         The same ion twice on a site
+    A_sum, B_sum, C_sum   The coefficients of the site do not sum to the
+                          expected value (1, 1 and 3 for ABC3), within the
+                          tolerance
+
+With normalize=True, sites that sum to within the tolerance of the expected
+value, but not exactly, are scaled to the expected sum, and the scaled
+coefficients rounded to decimals (4 by default, None to keep them as they are).
+
+Example:
+    validator = StoichiometryValidator(tolerance=0.02, normalize=True)
+    result = validate_compositions(frame, validator)    # in perovskite_batch
+    print(result.counts())
+"""
+
+from itertools import chain
+
+import numpy as np
+import pandas as pd
+
+missing_coefficient = 1
+extra_coefficient = 2
+invalid_coefficient = 4
+duplicate_ion = 8
+site_sum_errors = (16, 32, 64)
+
+error_names = {
+    missing_coefficient: "missing_coefficient",
+    extra_coefficient: "extra_coefficient",
+    invalid_coefficient: "invalid_coefficient",
+    duplicate_ion: "duplicate_ion",
+    site_sum_errors[0]: "A_sum",
+    site_sum_errors[1]: "B_sum",
+    site_sum_errors[2]: "C_sum",
+}
+
+# Sums closer than this to the expected value are left as they are when normalizing
+exact = 1e-9
+
+
+def coefficient_matrix(coef_lists, width):
+    """The coefficients of one site as a float array with one row per composition and width
+    columns, padded with NaN, and the number of coefficients in every row. Coefficients that
+    are not numbers are NaN"""
+    n = len(coef_lists)
+    lengths = np.fromiter(map(len, coef_lists), dtype=np.intp, count=n)
+    flat = list(chain.from_iterable(coef_lists))
+    try:
+        values = np.array(flat, dtype=float)
+    except (TypeError, ValueError):
+        values = pd.to_numeric(pd.Series(flat, dtype=object), errors="coerce").to_numpy(dtype=float)
+    full_width = max(width, int(lengths.max()) if n else 0)
+    matrix = np.full((n, full_width), np.nan)
+    matrix[np.arange(full_width) < lengths[:, None]] = values
+    return matrix[:, :width], lengths
+
+
+class ValidationResult:
+    "Error codes, site sums and (normalized) coefficients for every composition of a batch"
+    def __init__(self, errors, sums, coefficients, ion_counts, normalized):
+        self.errors = errors
+        self.sums = sums
+        self.coefficients = coefficients
+        self.ion_counts = ion_counts
+        self.normalized = normalized
+
+    def __len__(self):
+        return len(self.errors)
+
+    @property
+    def valid(self):
+        "True for the compositions without errors"
+        return self.errors == 0
+
+    def counts(self):
+        "Number of compositions with each error"
+        return {name: int(np.count_nonzero(self.errors & code)) for code, name in error_names.items()}
+
+    def describe(self, row):
+        "Names of the errors of one composition"
+        return [name for code, name in error_names.items() if self.errors[row] & code]
+
+    def row_coefficients(self, site_index, row):
+        "The coefficients of one site of one composition, as a list"
+        return self.coefficients[site_index][row, :self.ion_counts[site_index][row]].tolist()
+
+
+class StoichiometryValidator:
+    """Checks the coefficients of batches of compositions against the expected site sums.
+    drop_invalid is used by convert_many to leave out compositions with errors"""
+    def __init__(self, expected_sums=(1, 1, 3), tolerance=0.05, normalize=False, decimals=4,
+                 drop_invalid=False):
+        self.expected_sums = expected_sums
+        self.tolerance = tolerance
+        self.normalize = normalize
+        self.decimals = decimals
+        self.drop_invalid = drop_invalid
+
+    def check(self, site_coefs, ion_counts, duplicates=None):
+        """Check a batch. site_coefs has, per site, a list with the coefficients of every
+        composition, and ion_counts and duplicates have, per site, an array with the number of
+        ions and whether an ion is repeated for every composition"""
+        n = len(ion_counts[0])
+        errors = np.zeros(n, dtype=np.uint8)
+        sums = np.full((n, len(site_coefs)), np.nan)
+        normalized = np.zeros((n, len(site_coefs)), dtype=bool)
+        matrices = []
+        counts_per_site = []
+        for s, (coef_lists, counts, expected) in enumerate(zip(site_coefs, ion_counts, self.expected_sums)):
+            counts = np.asarray(counts, dtype=np.intp)
+            width = int(counts.max()) if n else 0
+            matrix, lengths = coefficient_matrix(coef_lists, width)
+
+            columns = np.arange(width)
+            in_site = columns < counts[:, None]
+            present = columns < np.minimum(lengths, counts)[:, None]
+            invalid = (present & ~(matrix >= 0)).any(axis=1)
+            errors[lengths < counts] |= missing_coefficient
+            errors[lengths > counts] |= extra_coefficient
+            errors[invalid] |= invalid_coefficient
+            if duplicates is not None:
+                errors[np.asarray(duplicates[s], dtype=bool)] |= duplicate_ion
+
+            # Sums are only checked for sites with a valid coefficient for every ion
+            complete = (lengths >= counts) & ~invalid
+            site_sum = np.where(in_site, matrix, 0.0).sum(axis=1)
+            site_sum[~complete] = np.nan
+            deviation = np.abs(site_sum - expected)
+            errors[complete & (deviation > self.tolerance)] |= site_sum_errors[s]
+            sums[:, s] = site_sum
+
+            if self.normalize:
+                scale = complete & (deviation > exact) & (deviation <= self.tolerance) & (site_sum > 0)
+                matrix[scale] *= (expected / site_sum[scale])[:, None]
+                if self.decimals is not None:
+                    matrix[scale] = np.round(matrix[scale], self.decimals)
+                normalized[:, s] = scale
+            matrices.append(matrix)
+            counts_per_site.append(counts)
+        return ValidationResult(errors, sums, matrices, counts_per_site, normalized)
@@ -0,0 +1,29 @@
+import pytest
+
+from columnar_export import read_columnar, write_columnar
+
+pytest.importorskip("pyarrow")
+
+
+def record(A_ions, A_coef):
+    record = {"Perovskite family": "".join(A_ions), "Perovskite composition": "", "Band gap": 1.5,
+              "Dimensionality": "3D", "Additives": []}
+    for site, ions, coef in (("A", A_ions, A_coef), ("B", [], []), ("C", [], [])):
+        record[f"{site}_ions"] = ions
+        record[f"{site}_coef"] = coef
+        for name in ("SMILES", "molecular_formula", "IUPAC_names", "common_names", "cas_numbers",
+                     "parent_SMILES", "parent_IUPAC_names", "parent_cas_numbers"):
+            record[f"{site}_{name}"] = ["x"] * len(ions)
+    return record
+
+
+@pytest.mark.parametrize("file_name", ["records.parquet", "records.arrow"])
+def test_exploded_keeps_records_without_ions(tmp_path, file_name):
+    records = [record(["MA"], [1]), record([], []), record(["Cs", "FA"], [0.1, 0.9])]
+    write_columnar(records, tmp_path / file_name, layout="exploded")
+    frame = read_columnar(tmp_path / file_name)
+    assert sorted(set(frame["record_id"])) == [0, 1, 2]
+    empty = frame[frame["record_id"] == 1]
+    assert len(empty) == 1
+    assert empty["ion"].isna().all() and empty["site"].isna().all() and empty["position"].isna().all()
+    assert list(frame[frame["record_id"] == 2]["ion"]) == ["Cs", "FA"]
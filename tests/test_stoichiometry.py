@@ -0,0 +1,28 @@
+import pandas as pd
+
+from perovskite_batch import convert_many
+from stoichiometry import StoichiometryValidator
+
+
+def composition_frame():
+    return pd.DataFrame({"A_ions": ["Cs; FA; MA"], "A_coef": ["0.05; 0.18; 0.79"], "B_ions": ["Pb"],
+                         "B_coef": ["1"], "C_ions": ["Br; I"], "C_coef": ["0.5; 2.5"]})
+
+
+def test_normalized_composition_is_rounded():
+    validator = StoichiometryValidator(tolerance=0.05, normalize=True)
+    record, = convert_many(composition_frame(), validator=validator)
+    assert record["A_coef"] == [0.049, 0.1765, 0.7745]
+    assert record["Perovskite composition"] == "Cs0.049FA0.1765MA0.7745PbBr0.5I2.5"
+
+
+def test_normalized_decimals():
+    validator = StoichiometryValidator(tolerance=0.05, normalize=True, decimals=2)
+    record, = convert_many(composition_frame(), validator=validator)
+    assert record["Perovskite composition"] == "Cs0.05FA0.18MA0.77PbBr0.5I2.5"
+
+
+def test_without_normalize_coefficients_are_unchanged():
+    validator = StoichiometryValidator(tolerance=0.05)
+    record, = convert_many(composition_frame(), validator=validator)
+    assert record["A_coef"] == [0.05, 0.18, 0.79]